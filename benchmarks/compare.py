@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+#
+# Compare two result files of run.py, for example from two commits,
+# and exit with status 1 if a benchmark got slower (or used more
+# memory) by more than the threshold.
+
+import argparse
+import json
+import sys
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('-t', '--threshold', type=float, default=1.2,
+                        help='ratio after/before above which a change is a regression')
+    args = parser.parse_args()
+
+    with open(args.before) as fp:
+        before = json.load(fp)
+    with open(args.after) as fp:
+        after = json.load(fp)
+    if before.get('scale') != after.get('scale'):
+        print('Warning: the results were run with different workload sizes')
+
+    print('before:', before.get('commit'), before.get('date'))
+    print('after: ', after.get('commit'), after.get('date'))
+    print()
+    print('%-32s %10s %10s %7s %10s %10s %7s' % ('benchmark', 'before s', 'after s', 'ratio',
+                                                 'before MB', 'after MB', 'ratio'))
+    regressions = []
+    for name in sorted(set(before['results']) | set(after['results'])):
+        if name not in before['results'] or name not in after['results']:
+            print('%-32s only in %s' % (name, 'after' if name in after['results'] else 'before'))
+            continue
+        b = before['results'][name]
+        a = after['results'][name]
+        tratio = a['min'] / b['min'] if b['min'] > 0 else float('inf')
+        mratio = a['peak_memory'] / b['peak_memory'] if b['peak_memory'] > 0 else float('inf')
+        flag = ''
+        if tratio > args.threshold or mratio > args.threshold:
+            flag = ' <-'
+            regressions.append(name)
+        print('%-32s %10.4f %10.4f %7.2f %10.1f %10.1f %7.2f%s' % (
+            name, b['min'], a['min'], tratio, b['peak_memory'] / 2 ** 20,
+            a['peak_memory'] / 2 ** 20, mratio, flag))
+
+    if len(regressions) > 0:
+        print()
+        print('%d regression(s) above %.2fx' % (len(regressions), args.threshold))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
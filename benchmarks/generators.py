@@ -0,0 +1,129 @@
+# generators.py
+#
+# Seeded generators of synthetic FSTs for the benchmarks, shaped like
+# the FSTs built by lm.py and cmudict2fst.py.
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fst
+
+def words(n, seed=0):
+    """
+    Return a list of n distinct made-up words.
+    """
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    result = set()
+    while len(result) < n:
+        result.add(''.join(rng.choice(letters) for i in range(rng.randint(2, 8))))
+    return sorted(result)
+
+def random_fst(nstates, narcs, nsyms=10, eps=0.1, seed=0):
+    """
+    Return a random FST with nstates integer states, narcs
+    transitions, nsyms symbols, and a fraction eps of EPS input and
+    output symbols. Every state is on a path from the initial state
+    (0) to a final state, so cleanup() keeps it whole.
+    """
+    rng = random.Random(seed)
+    syms = ['s%d' % i for i in range(nsyms)]
+
+    def sym():
+        return fst.EPS if rng.random() < eps else rng.choice(syms)
+
+    f = fst.FST()
+    f.set_initial(0)
+    f.set_final(nstates - 1)
+    for q in range(nstates - 1):
+        f.add_transition(q, q + 1, rng.choice(syms), rng.choice(syms), rng.randint(0, 9))
+    for i in range(narcs - (nstates - 1)):
+        f.add_transition(rng.randrange(nstates), rng.randrange(nstates), sym(), sym(),
+                         rng.randint(0, 9))
+    return f
+
+def backoff_lm(vocab, nbigrams, seed=0):
+    """
+    Return a bigram LM over vocab shaped like those of lm.py: a state
+    per word, a transition for each of nbigrams random bigrams, a
+    failure (PHI) transition from each word state to <unigram_state>,
+    which has a transition for every word, and EPS transitions into
+    the final state </s>.
+    """
+    rng = random.Random(seed)
+    lm = fst.FST()
+    lm.set_initial('<s>')
+    lm.set_final('</s>')
+    for w in vocab:
+        lm.add_transition('<unigram_state>', w, w, w, rng.uniform(2, 12))
+    lm.add_transition('<unigram_state>', '</s>', fst.EPS, fst.EPS, rng.uniform(2, 12))
+    for h in ['<s>'] + vocab:
+        lm.add_transition(h, '<unigram_state>', fst.PHI, fst.PHI, rng.uniform(0.5, 3))
+        lm.add_transition(h, '</s>', fst.EPS, fst.EPS, rng.uniform(1, 8))
+    for i in range(nbigrams):
+        h = rng.choice(['<s>'] + vocab)
+        w = rng.choice(vocab)
+        lm.add_transition(h, w, w, w, rng.uniform(0.5, 8))
+    return lm
+
+def pronunciations(vocab, nphones=40, seed=0):
+    """
+    Return made-up (word, phones) entries for vocab, a few words
+    with more than one pronunciation, shaped like cmudict entries.
+    """
+    rng = random.Random(seed)
+    phones = ['P%d' % i for i in range(nphones)]
+    entries = []
+    for w in vocab:
+        for i in range(1 if rng.random() < 0.9 else 2):
+            entries.append((w, [rng.choice(phones) for j in range(rng.randint(2, 9))]))
+    return entries
+
+def lexicon(vocab, nphones=40, seed=0):
+    """
+    Return the p2w (phones to word) FST of made-up pronunciations
+    for vocab, with one chain of states per entry, as cmudict2fst.py
+    built it before from_lexicon().
+    """
+    p2w = fst.FST()
+    p2w.set_initial(0)
+    p2w.set_final(0)
+    nstates = 1
+    for w, phones in pronunciations(vocab, nphones, seed):
+        q = 0
+        for p in phones[:-1]:
+            p2w.add_transition(q, nstates, p, fst.EPS)
+            q = nstates
+            nstates += 1
+        p2w.add_transition(q, 0, phones[-1], w)
+    return p2w
+
+def min_lexicon(vocab, nphones=40, seed=0):
+    """
+    Return the p2w FST of made-up pronunciations for vocab built
+    with from_lexicon(), as cmudict2fst.py does.
+    """
+    return fst.from_lexicon(((phones, [w]) for w, phones in pronunciations(vocab, nphones, seed)),
+                            sorted=False, closure=True)
+
+def phone_input(vocab, nwords, nphones=40, seed=0):
+    """
+    Return the phones of a random sentence of nwords words of vocab,
+    with the pronunciations of lexicon().
+    """
+    rng = random.Random(seed + 1)
+    prons = dict(pronunciations(vocab, nphones, seed))
+    result = []
+    for i in range(nwords):
+        result.extend(prons[rng.choice(vocab)])
+    return result
+
+def word_input(vocab, length, seed=0):
+    """
+    Return a random string of length words of vocab.
+    """
+    rng = random.Random(seed)
+    return [rng.choice(vocab) for i in range(length)]
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+#
+# Run the benchmarks and write their results as JSON, to compare
+# them across commits with compare.py. For example:
+#
+#   python benchmarks/run.py -o before.json
+#   (change something)
+#   python benchmarks/run.py -o after.json
+#   python benchmarks/compare.py before.json after.json
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import generators
+from generators import fst
+
+# Each benchmark is a function that takes the size factor (1 for the
+# full workloads, smaller with --quick) and returns a pair of
+# functions: setup(), which builds the inputs and is not timed, and
+# run(inputs), which is timed.
+BENCHMARKS = {}
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+@benchmark('compose/random')
+def compose_random(scale):
+    def setup():
+        return (generators.random_fst(int(200 * scale), int(1000 * scale), seed=1),
+                generators.random_fst(int(200 * scale), int(1000 * scale), seed=2))
+    return setup, lambda fs: fst.compose(fs[0], fs[1])
+
+@benchmark('compose/chain_lexicon_lm')
+def compose_cascade(scale):
+    def setup():
+        vocab = generators.words(int(2000 * scale))
+        chain = fst.linear_chain(generators.phone_input(vocab, 50))
+        return chain, generators.lexicon(vocab), generators.backoff_lm(vocab, int(20000 * scale))
+    return setup, lambda fs: fst.compose(fst.compose(fs[0], fs[1]), fs[2])
+
+@benchmark('compose/chain_minlexicon_lm')
+def compose_cascade_min(scale):
+    def setup():
+        vocab = generators.words(int(2000 * scale))
+        chain = fst.linear_chain(generators.phone_input(vocab, 50))
+        return chain, generators.min_lexicon(vocab), generators.backoff_lm(vocab, int(20000 * scale))
+    return setup, lambda fs: fst.compose(fst.compose(fs[0], fs[1]), fs[2])
+
+@benchmark('cleanup/random')
+def cleanup_random(scale):
+    def setup():
+        f = generators.random_fst(int(2000 * scale), int(20000 * scale), seed=3)
+        # Dead states, reachable but not coaccessible.
+        for q in range(int(2000 * scale)):
+            f.add_transition(q, ('dead', q), 's0', 's0')
+            f.add_transition(('dead', q), ('dead', q + 1), 's1', 's1')
+        return f
+    return setup, lambda f: f.cleanup()
+
+def short_paths_benchmark(n):
+    def bench(scale):
+        def setup():
+            syms = ['s%d' % i for i in range(10)]
+            chain = fst.linear_chain(generators.word_input(syms, int(200 * scale)))
+            return fst.compose(chain, generators.random_fst(20, 400, seed=4))
+        return setup, lambda c: c.short_paths(n)
+    return bench
+
+for n in (1, 10, 100):
+    benchmark('short_paths/n=%d' % n)(short_paths_benchmark(n))
+
+@benchmark('short_paths/lazy_cascade')
+def short_paths_lazy(scale):
+    def setup():
+        vocab = generators.words(int(2000 * scale))
+        chain = fst.linear_chain(generators.phone_input(vocab, 50))
+        return chain, generators.lexicon(vocab), generators.backoff_lm(vocab, int(20000 * scale))
+    def run(fs):
+        c = fst.compose(fst.compose(fs[0], fs[1], lazy=True), fs[2], lazy=True)
+        return c.short_paths(10)
+    return setup, run
+
+@benchmark('prune/lattice')
+def prune_lattice(scale):
+    def setup():
+        vocab = generators.words(int(2000 * scale))
+        chain = fst.linear_chain(generators.phone_input(vocab, 50, nphones=8))
+        lattice = fst.compose(chain, generators.lexicon(vocab, nphones=8))
+        lattice.cleanup()
+        return lattice.freeze()
+    def run(lattice):
+        fst.prune(lattice, 5).short_paths(10)
+        fst.posteriors(lattice)
+    return setup, run
+
+@benchmark('transduce/lexicon')
+def transduce_lexicon(scale):
+    def setup():
+        vocab = generators.words(int(2000 * scale))
+        return generators.lexicon(vocab), generators.phone_input(vocab, 20)
+    return setup, lambda args: args[0].transduce(args[1], n=10, verbose=0)
+
+@benchmark('decode/lm')
+def decode_lm(scale):
+    def setup():
+        vocab = generators.words(int(2000 * scale))
+        return (generators.backoff_lm(vocab, int(20000 * scale)),
+                generators.word_input(vocab, int(200 * scale)))
+    return setup, lambda args: args[0].decode(args[1], n=10)
+
+@benchmark('inverted/lm')
+def inverted_lm(scale):
+    def setup():
+        return generators.backoff_lm(generators.words(int(2000 * scale)), int(50000 * scale))
+    return setup, fst.inverted
+
+@benchmark('freeze/lm')
+def freeze_lm(scale):
+    def setup():
+        return generators.backoff_lm(generators.words(int(2000 * scale)), int(50000 * scale))
+    return setup, lambda f: f.freeze()
+
+@benchmark('att/lm')
+def att_lm(scale):
+    def setup():
+        return generators.backoff_lm(generators.words(int(2000 * scale)), int(50000 * scale))
+    def run(f):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'lm.txt')
+            fst.write_att(f, fname)
+            fst.read_att(fname)
+        finally:
+            shutil.rmtree(tmpdir)
+    return setup, run
+
+def save_load_benchmark(binary, mmap):
+    def bench(scale):
+        def setup():
+            f = generators.backoff_lm(generators.words(int(2000 * scale)), int(50000 * scale))
+            return f.freeze() if binary else f
+        def run(f):
+            tmpdir = tempfile.mkdtemp()
+            try:
+                fname = os.path.join(tmpdir, 'lm.fst')
+                f.save(fname, binary=binary)
+                g = fst.load(fname, mmap=mmap)
+                # Touch the transitions, so that lazy loading is timed too.
+                len(g.transitions)
+            finally:
+                shutil.rmtree(tmpdir)
+        return setup, run
+    return bench
+
+benchmark('save_load/pickle')(save_load_benchmark(False, False))
+benchmark('save_load/binary')(save_load_benchmark(True, False))
+benchmark('save_load/binary_mmap')(save_load_benchmark(True, True))
+
+def measure(bench, scale, repeat):
+    """
+    Run a benchmark repeat times, and return its wall clock times
+    and the peak memory allocated by one more run.
+    """
+    setup, run = bench(scale)
+    times = []
+    for i in range(repeat):
+        inputs = setup()
+        gc.collect()
+        start = time.perf_counter()
+        run(inputs)
+        times.append(time.perf_counter() - start)
+
+    inputs = setup()
+    gc.collect()
+    tracemalloc.start()
+    run(inputs)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return times, peak
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the fst benchmarks.')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='JSON file for the results')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run the benchmarks whose name contains this')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of timed runs of each benchmark')
+    parser.add_argument('--quick', action='store_true',
+                        help='run smaller workloads')
+    args = parser.parse_args()
+
+    scale = 0.1 if args.quick else 1
+    results = {}
+    for name in sorted(BENCHMARKS):
+        if args.filter not in name:
+            continue
+        times, peak = measure(BENCHMARKS[name], scale, args.repeat)
+        results[name] = {'min': min(times), 'median': sorted(times)[len(times) // 2],
+                         'times': times, 'peak_memory': peak}
+        print('%-32s %10.4f s %10.1f MB' % (name, min(times), peak / 2 ** 20), flush=True)
+
+    report = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': fst.np is not None,
+        'scale': scale,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=2)
+
+if __name__ == '__main__':
+    main()
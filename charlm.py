@@ -1,8 +1,12 @@
 import fst
 import math
 import sys
-from collections import Counter, defaultdict
-import random
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Get the command line parameters:
 # the order, the training file, and the output language model file
@@ -16,77 +20,151 @@ order = int(sys.argv[1])
 # the length of the history, or context
 histlen = order - 1
 
-# the number of times we have each context in the training set
-histfreq = Counter()
-
-# the number of times we have each ngram in the training set
-ngramfreq = defaultdict(Counter)
-
-# open the training file, and go through it line by line
+# the number of lines we count at a time
+CHUNK_LINES = 100000
+
+# Symbols are coded as integers: 0 is EPS (which we don't use, but
+# the FST symbol table has it), 1 is the <s> padding symbol, 2 is the
+# </s> end of string symbol, and the characters follow. An ngram is
+# coded as a single integer key, with one digit per symbol in base
+# nsyms, so the key of the history of an ngram is key // nsyms, the
+# key of its last symbol is key % nsyms, and the key of the history
+# that follows it is key % nsyms ** histlen.
+BOS = 1
+EOS = 2
+
+def read_chunks(fname):
+    """
+    Read a file in chunks of CHUNK_LINES lines, without their
+    newlines.
+    """
+    with open(fname, 'r', encoding='utf-8') as fp:
+        chunk = []
+        for line in fp:
+            # the | character was the history separator of earlier
+            # versions of this script, which replaced it with /, and
+            # we still do, so that LMs keep the same symbols
+            chunk.append(line.strip().replace('|', '/'))
+            if len(chunk) == CHUNK_LINES:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+def count_chunk_numpy(chunk, codepoints, nsyms):
+    """
+    Count the ngrams of a chunk of lines with NumPy, and return
+    their keys and counts as two arrays.
+    """
+    lengths = np.array([len(line) for line in chunk], dtype=np.int64)
+    text = np.frombuffer(''.join(chunk).encode('utf-32-le'), dtype='<u4')
+    ids = np.searchsorted(codepoints, text) + 3
+
+    # Lay the lines out one after the other, each padded with
+    # histlen <s> symbols and ended with </s>.
+    padded = lengths + histlen + 1
+    starts = np.concatenate(([0], np.cumsum(padded)[:-1]))
+    seq = np.full(int(padded.sum()), BOS, dtype=np.int64)
+    firsts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    pos = np.repeat(starts + histlen - firsts, lengths) + np.arange(len(ids))
+    seq[pos] = ids
+    seq[starts + histlen + lengths] = EOS
+
+    # The last positions of the ngrams: every position of each line
+    # after its padding.
+    nends = lengths + 1
+    firsts = np.concatenate(([0], np.cumsum(nends)[:-1]))
+    ends = np.repeat(starts + histlen - firsts, nends) + np.arange(int(nends.sum()))
+
+    keys = np.zeros(len(ends), dtype=np.int64)
+    for j in range(order):
+        keys = keys * nsyms + seq[ends - histlen + j]
+    return np.unique(keys, return_counts=True)
+
+def count_chunk(chunk, symbol_ids, nsyms):
+    """
+    Count the ngrams of a chunk of lines, and return a Counter of
+    their keys.
+    """
+    counts = Counter()
+    for line in chunk:
+        seq = [BOS] * histlen + [symbol_ids[c] for c in line] + [EOS]
+        for i in range(histlen, len(seq)):
+            key = 0
+            for sym in seq[i - histlen:i + 1]:
+                key = key * nsyms + sym
+            counts[key] += 1
+    return counts
+
+# First we find the characters in the training file, since we need
+# to know how many symbols there are to code them.
 print("Building character LM...")
-with open(sys.argv[2], 'r', encoding='utf-8') as fp:
-    # each line is a string
-    for line in fp:
-        # we will use the | character as a special character, so it appears in 
-        # the string, just replace it with /
-        line = line.strip().replace('|', '/')
-
-        # add as many <s> padding symbols to the string as needed,
-        # and add the </s> end of string symbol
-        #
-        # list(line) makes a list with the characters of line
-        # ['<s>'] * histlen makes a list that contains <s> histlen times
-        # adding two lists just puts them together into one list
-        curr_string = (['<s>'] * histlen) + list(line) + ['</s>']
-
-        # now we go through each ngram in the current string
-        for i in range((histlen), len(curr_string)):
-            # the history, or the context, is the substring made of
-            # the previous histlen characters
-            hist = '|'.join(curr_string[i - histlen:i])
-
-            # here's the count we are interested in:
-            # after context hist, we see the current character and count it
-            ngramfreq[hist][curr_string[i]] += 1
-
-            # and we increase the count of how many times we saw this context,
-            # since this will be the denominator when we compute P(curr_string[i]|hist)
-            histfreq[hist] += 1
+chars = set()
+for chunk in read_chunks(sys.argv[2]):
+    for line in chunk:
+        chars.update(line)
+chars = sorted(chars)
+symbols = [fst.EPS, '<s>', '</s>'] + chars
+symbol_ids = dict((sym, i) for i, sym in enumerate(symbols))
+nsyms = len(symbols)
+
+# Then we count the ngrams, with NumPy if the keys fit in 64 bits,
+# adding the counts of each chunk to the counts so far.
+use_numpy = np is not None and nsyms ** order < 2 ** 63
+if use_numpy:
+    codepoints = np.array([ord(c) for c in chars], dtype='<u4')
+    keys = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    for chunk in read_chunks(sys.argv[2]):
+        chunk_keys, chunk_counts = count_chunk_numpy(chunk, codepoints, nsyms)
+        keys, inverse = np.unique(np.concatenate((keys, chunk_keys)), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate((counts, chunk_counts)),
+                             minlength=len(keys)).astype(np.int64)
+else:
+    ngramfreq = Counter()
+    for chunk in read_chunks(sys.argv[2]):
+        ngramfreq.update(count_chunk(chunk, symbol_ids, nsyms))
+    keys = sorted(ngramfreq)
+    counts = [ngramfreq[key] for key in keys]
 
 # now we have all the parameters of the character ngram model
 print("Done")
 
 print("Encoding LM as FST")
 
-# create an FST
-lm = fst.FST()
-
-# the initial state is where we have only the <s> padding symbols,
-# and we are ready for the first character in the string
-lm.set_initial('|'.join(['<s>'] * histlen))
-
-# the final state
-lm.set_final('</s>')
-
-# go through all the contexts in our count of contexts in the training set
-for ctxt in histfreq:
-    # go through all the symbols that have follow that context
-    for sym in ngramfreq[ctxt]:
-        # we need a transition from state ctxt to state newctxt,
-        # which reflects that we just saw sym as input
-        #
-        # if a bigram model, newctxt is just the current input symbol,
-        # but with larger ngrams, newctxt is the entire new context
-        if order > 2:
-            newctxt = ctxt[(ctxt.find('|') + 1):] + '|' + sym
-        else:
-            newctxt = sym
-        if sym == '</s>':
-            newctxt = sym
-
-        # create the transition from ctxt to newctxt, with symbol sym
-        # and set the weight according to the counts from the training set
-        lm.add_transition(ctxt, newctxt, sym, sym, -math.log(ngramfreq[ctxt][sym]/histfreq[ctxt]))
+# Each history is a state, numbered in the order of the keys, and
+# the final state comes last. Each ngram is a transition, with the
+# history of the ngram as source state, its last symbol as label, and
+# the history that follows it as destination. The weight of a
+# transition is -log P(symbol | history), from the counts.
+initial_key = 0
+for i in range(histlen):
+    initial_key = initial_key * nsyms + BOS
+histmod = nsyms ** histlen
+
+if use_numpy:
+    hists, src = np.unique(keys // nsyms, return_inverse=True)
+    labels = keys % nsyms
+    dst = np.searchsorted(hists, keys % histmod)
+    dst[labels == EOS] = len(hists)
+    histfreq = np.bincount(src, weights=counts)
+    weights = -np.log(counts / histfreq[src])
+    initial = int(np.searchsorted(hists, initial_key))
+else:
+    hists = sorted(set(key // nsyms for key in keys))
+    hist_ids = dict((h, i) for i, h in enumerate(hists))
+    histfreq = Counter()
+    for key, cnt in zip(keys, counts):
+        histfreq[key // nsyms] += cnt
+    src = [hist_ids[key // nsyms] for key in keys]
+    labels = [key % nsyms for key in keys]
+    dst = [len(hists) if key % nsyms == EOS else hist_ids[key % histmod] for key in keys]
+    weights = [-math.log(cnt / histfreq[key // nsyms]) for key, cnt in zip(keys, counts)]
+    initial = hist_ids[initial_key]
+nstates = len(hists) + 1
+
+lm = fst.from_arrays(src, dst, labels, labels, weights, symbols,
+                     initial, [nstates - 1], nstates)
 
 print("Done")
 
@@ -3,12 +3,90 @@
 # Weighted Finite State Transducers, with composition and
 # shortest paths.
 
+import os
+import sys
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import mmap
 import pickle
+import contextlib
 import heapq
-from collections import defaultdict, deque
+import json
+import math
+import random
+import struct
+import time
+import multiprocessing
+import queue
+from array import array
+from collections import Counter, defaultdict, deque, namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 EPS='<eps>'
 
+# A failure (phi) transition has PHI as input symbol and is only
+# taken, without reading anything, when no other transition leaving
+# its state can read the next symbol, as in a backoff n-gram LM.
+PHI='<phi>'
+
+# The counters of collect_stats(), or None when no statistics are
+# being collected.
+_stats = None
+
+@contextlib.contextmanager
+def collect_stats(callback=None):
+    """
+    Collect statistics about the work done by compose(), cleanup()
+    and the searches (short_paths(), decode(), transduce()) in a
+    with block, as in:
+
+        with fst.collect_stats() as stats:
+            myfst.transduce(['a', 'test'])
+        print(stats)
+
+    stats is a Counter with these keys:
+
+        compose.calls, compose.time: eager compose() calls, and the
+            seconds spent in them (including their cleanup())
+        compose.states, compose.arcs: product states expanded, and
+            transitions built for them (also by lazy compositions)
+        cleanup.calls, cleanup.time, cleanup.states_removed,
+            cleanup.arcs_removed
+        search.calls, search.time
+        search.pushes, search.pops: heap items pushed and popped
+        search.expansions: popped items that were expanded
+        search.duplicates: popped items dropped because an item
+            with the same strings was expanded in the same state
+        search.states: states expanded at least once
+        search.trie_nodes: nodes of the trie of strings
+        search.paths: paths returned
+
+    If callback is given, it is called with a dict of the
+    statistics when the block ends. Statistics of nested blocks
+    are also added to the outer ones. When no statistics are being
+    collected, the only cost is a check per call (and per product
+    state in compositions). Work done in other processes, such as
+    the workers of transduce_batch(), is not counted.
+    """
+    global _stats
+    outer = _stats
+    stats = Counter()
+    _stats = stats
+    try:
+        yield stats
+    finally:
+        _stats = outer
+        if outer is not None:
+            outer.update(stats)
+        if callback is not None:
+            callback(dict(stats))
+
 class FST(object):
     """
     A finite-state transducer, defined as an initial state,
@@ -31,7 +109,33 @@ class FST(object):
         self.transitions_by_isym = defaultdict(set)
         self.transitions_by_osym = defaultdict(set)
         self.transitions_by_state = defaultdict(set)
-        
+        self._reset_caches()
+
+    def _reset_caches(self):
+        # Per-state label indexes, built on demand by arcs_by_isym()
+        # and arcs_by_osym(), and dropped when the state changes.
+        self._isym_index = {}
+        self._osym_index = {}
+        # Tables computed over the whole FST, such as the distances
+        # from distance_to_final(), dropped on any change.
+        self._cache = {}
+
+    def _invalidate(self, state):
+        self._isym_index.pop(state, None)
+        self._osym_index.pop(state, None)
+        self._cache.clear()
+
+    def __getstate__(self):
+        # Caches are not saved with the FST.
+        state = self.__dict__.copy()
+        for key in ('_isym_index', '_osym_index', '_cache'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_caches()
+
     def add_transition(self, state1, state2, isym, osym, weight=0):
         """
         Add a transition to the FST. If the transition already
@@ -46,6 +150,8 @@ class FST(object):
         self.transitions_by_state[state1].add((state1, state2, isym, osym))
         self.transitions_by_isym[isym].add((state1, state2, isym, osym))
         self.transitions_by_osym[osym].add((state1, state2, isym, osym))
+        if self._isym_index or self._osym_index or self._cache:
+            self._invalidate(state1)
 
     def add_transitions(self, state1, state2, symlist, weight=0):
         """
@@ -67,30 +173,142 @@ class FST(object):
             self.transitions_by_state[t[0]].remove(t)
             self.from_states[t[0]] -= 1
             self.to_states[t[1]] -= 1
+            self._invalidate(t[0])
+
+    def arcs(self, state):
+        """
+        Return a list of (transition, weight) pairs for the
+        transitions leaving state.
+        """
+        return [(t, self.transitions[t])
+                for t in self.transitions_by_state.get(state, ())]
+
+    def arcs_by_isym(self, state):
+        """
+        Return a dict that maps each input symbol to the list of
+        (transition, weight) pairs leaving state with that input
+        symbol. The index is built on first use and kept until the
+        transitions of state change.
+        """
+        index = self._isym_index.get(state)
+        if index is None:
+            index = {}
+            for t, w in self.arcs(state):
+                index.setdefault(t[2], []).append((t, w))
+            self._isym_index[state] = index
+        return index
+
+    def arcs_by_osym(self, state):
+        """
+        Same as arcs_by_isym(), but indexed by output symbol.
+        """
+        index = self._osym_index.get(state)
+        if index is None:
+            index = {}
+            for t, w in self.arcs(state):
+                index.setdefault(t[3], []).append((t, w))
+            self._osym_index[state] = index
+        return index
+
+    def freeze(self):
+        """
+        Return a compact, immutable copy of the FST as a ConstFST.
+        States and symbols are replaced by integer ids, and the
+        transitions are stored in flat arrays. The original state
+        names are kept in the state_names list of the result.
+        """
+        state_ids = {}
+        state_names = []
+        candidates = [self.initial] if self.initial is not None else []
+        candidates.extend(self.states)
+        candidates.extend(self.final)
+        for s in candidates:
+            if s not in state_ids:
+                state_ids[s] = len(state_names)
+                state_names.append(s)
+
+        symbols = [EPS]
+        symbol_ids = {EPS: 0}
+        offsets = array('q', [0])
+        nextstates = array('i')
+        ilabels = array('i')
+        olabels = array('i')
+        weights = array('d')
+        for s in state_names:
+            for t in self.transitions_by_state.get(s, ()):
+                for sym in (t[2], t[3]):
+                    if sym not in symbol_ids:
+                        symbol_ids[sym] = len(symbols)
+                        symbols.append(sym)
+                nextstates.append(state_ids[t[1]])
+                ilabels.append(symbol_ids[t[2]])
+                olabels.append(symbol_ids[t[3]])
+                weights.append(self.transitions[t])
+            offsets.append(len(nextstates))
+
+        initial = state_ids.get(self.initial)
+        final = set(state_ids[s] for s in self.final)
+        return ConstFST(symbols, offsets, nextstates, ilabels, olabels,
+                        weights, initial, final, state_names)
 
     def cleanup(self):
         """
-        Remove unused states and transitions.
+        Remove unused states and transitions. Only the states that
+        are on some path from the initial state to a final state
+        are kept, along with the transitions between them. This is
+        a forward pass from the initial state and a backward pass
+        from the final states, so it takes time linear in the size
+        of the FST, and it also removes cycles that cannot reach a
+        final state.
         """
-        states_to_remove = []
-        while True:
-            transitions_to_remove = set()
-            for t in self.transitions:
-                if self.to_states[t[0]] == 0 and t[0] != self.initial:
-                    transitions_to_remove.add(t)
-                if self.from_states[t[1]] == 0 and t[1] not in self.final:
-                    transitions_to_remove.add(t)
-            for t in transitions_to_remove:
-                self.rm_transition(t)
-            if len(transitions_to_remove) == 0:
-                break
-        for s in self.states:
-            if self.from_states[s] == 0 and self.to_states[s] == 0:
-                states_to_remove.append(s)
+        if _stats is not None:
+            start = time.perf_counter()
+            nstates = len(self.states)
+        # Forward pass: states reachable from the initial state.
+        accessible = set()
+        if self.initial is not None:
+            accessible.add(self.initial)
+            a = deque([self.initial])
+            while len(a) > 0:
+                q = a.popleft()
+                for t in self.transitions_by_state.get(q, ()):
+                    if t[1] not in accessible:
+                        accessible.add(t[1])
+                        a.append(t[1])
+
+        # Backward pass over the accessible part: states that can
+        # reach a final state.
+        reverse = defaultdict(list)
+        for q in accessible:
+            for t in self.transitions_by_state.get(q, ()):
+                reverse[t[1]].append(q)
+        connected = set(s for s in self.final if s in accessible)
+        a = deque(connected)
+        while len(a) > 0:
+            q = a.popleft()
+            for p in reverse[q]:
+                if p not in connected:
+                    connected.add(p)
+                    a.append(p)
+
+        transitions_to_remove = [t for t in self.transitions
+                                 if t[0] not in connected or
+                                 t[1] not in connected]
+        for t in transitions_to_remove:
+            self.rm_transition(t)
+
+        states_to_remove = [s for s in self.states if s not in connected]
         for s in states_to_remove:
             self.states.remove(s)
-            del self.from_states[s]
-            del self.to_states[s]
+            self.from_states.pop(s, None)
+            self.to_states.pop(s, None)
+            self.transitions_by_state.pop(s, None)
+
+        if _stats is not None:
+            _stats['cleanup.calls'] += 1
+            _stats['cleanup.time'] += time.perf_counter() - start
+            _stats['cleanup.states_removed'] += nstates - len(self.states)
+            _stats['cleanup.arcs_removed'] += len(transitions_to_remove)
             
     def set_initial(self, s):
         """
@@ -103,70 +321,188 @@ class FST(object):
         Set state s as a final state. There can be multiple final states.
         """
         self.final.add(s)
+        self._cache.clear()
 
     def unset_final(self, s):
         if s in self.final:
             self.final.remove(s)
+            self._cache.clear()
+
+    def distance_to_final(self):
+        """
+        Return a dict with the shortest distance from each state to
+        a final state. States that cannot reach a final state are
+        left out. The distances are computed with Dijkstra's
+        algorithm on the reversed FST, and cached until the FST
+        is modified.
+        Won't work with negative weights.
+        """
+        dist = self._cache.get('distance_to_final')
+        if dist is None:
+            dist = _distance_to_final(self)
+            self._cache['distance_to_final'] = dist
+        return dist
 
-    def short_paths(self, n=1, dups=False):
+    def short_paths(self, n=1, dups=False, astar=False, beam=None,
+                    max_active=None, max_expansions=None):
         """
-        Find n shortest paths. 
+        Find the n shortest paths from the initial state to a final
+        state. Returns a PathList of Path (weight, input symbols,
+        output symbols) tuples in order of increasing weight, with EPS
+        removed from the symbol lists. Unless dups is True, a path
+        with the same input and output strings as a shorter path
+        is skipped.
+
+        If astar is True, the search is A* search guided by
+        distance_to_final(), which is cached on the FST (and, for
+        a lazy composition, on its operands), so it pays off when
+        the same FST is searched many times. States that cannot
+        reach a final state are never expanded.
+
+        The search can be pruned to bound its cost, at the risk of
+        missing some of the n shortest paths:
+        beam discards partial paths whose weight exceeds, by more
+        than beam, the best weight seen for a partial path that has
+        read the same number of input symbols (it is applied when a
+        path reads a symbol, not on epsilon moves); max_active expands
+        at most that many partial paths per number of input symbols
+        read; and max_expansions stops the search after that many
+        expansions in total. The pruned attribute of the result is
+        True if pruning discarded anything, i.e. if the result may
+        differ from the exact one.
         Won't work with negative weights.
         """
-        if self.initial == None:
+        if self.initial is None:
             return None
         if len(self.final) == 0:
             return None
 
-        # Best first search, from the initial state to any of
-        # the final states. Won't work with negative weights.
-        
-        h = []
-        itemcnt = 0
-        heapq.heappush(h, (0, itemcnt, self.initial, []))
+        heuristic = None
+        if astar:
+            heuristic = self.distance_to_final().get
+        return _search(self.initial, self.final.__contains__, self.arcs,
+                       n, dups, heuristic, beam, max_active, max_expansions)
+
+    def decode(self, input_symbols, n=1, dups=False, astar=False, beam=None,
+               max_active=None, max_expansions=None):
+        """
+        Find the n shortest paths of the FST that read the input
+        string input_symbols (a list of symbols), as a PathList like
+        the one returned by short_paths(), which describes the
+        remaining arguments.
+
+        This is the same as composing linear_chain(input_symbols)
+        with the FST and searching the result, but no FST is built:
+        the search walks this FST directly, with the position in the
+        input as part of the search state, and follows arcs with EPS
+        as input symbol without moving in the input. Failure (PHI)
+        transitions are followed as in compose().
+        """
+        if self.initial is None or len(self.final) == 0:
+            return PathList()
+
+        input_symbols = [sym for sym in input_symbols if sym != EPS]
+        nsyms = len(input_symbols)
+        final = self.final
+
+        def is_final(state):
+            return state[0] == nsyms and state[1] in final
+
+        def arcs(state):
+            pos, q = state
+            index = self.arcs_by_isym(q)
+            result = [((state, (pos, t[1]), EPS, t[3]), w)
+                      for t, w in _matching_arcs(self, q, index, EPS)]
+            if pos < nsyms:
+                for t, w in _matching_arcs(self, q, index, input_symbols[pos]):
+                    result.append(((state, (pos + 1, t[1]), t[2], t[3]), w))
+            return result
+
+        heuristic = None
+        if astar:
+            dist = self.distance_to_final()
+            heuristic = lambda state: dist.get(state[1])
+
+        return _search((0, self.initial), is_final, arcs, n, dups,
+                       heuristic, beam, max_active, max_expansions)
+
+    def sample(self, n=1, seed=None, max_len=None):
+        """
+        Draw n random paths from the initial state to a final state,
+        and return them as a list of Paths (weight, input symbols,
+        output symbols) like those of short_paths(). The weights of
+        the transitions leaving each state are taken as -log
+        probabilities, normalized to add up to one, and a path ends
+        as soon as it reaches a final state. Failure (PHI)
+        transitions are sampled by rejection: after one, a transition
+        is drawn from its destination, and the draw is repeated if
+        the original state has its own transition with the symbol
+        drawn.
+
+        The tables to draw transitions in constant time (alias
+        tables) are built the first time a state is visited, and
+        kept until the FST changes. For a ConstFST without failure
+        transitions, if NumPy is available, all the paths are drawn
+        together, one transition at a time. The same seed gives the
+        same paths. Paths that reach a state without transitions, or
+        that would be longer than max_len transitions, are dropped,
+        so fewer than n paths may be returned; use max_len if the FST
+        may have cycles that cannot reach a final state.
+        """
+        if self.initial is None:
+            return []
+        if (np is not None and isinstance(self, ConstFST) and
+                PHI not in self.symbol_ids):
+            return _sample_arrays(self, n, seed, max_len)
+
+        rng = random.Random(seed)
+        tables = self._cache.setdefault('alias', {})
+
+        def draw(state):
+            # Draw a transition leaving state, following failure
+            # transitions, as a (transition, weight) pair.
+            table = tables.get(state)
+            if table is None:
+                arcs = self.arcs(state)
+                table = (arcs,) + _alias_table([w for t, w in arcs])
+                tables[state] = table
+            arcs, prob, alias = table
+            while len(arcs) > 0:
+                i = int(rng.random() * len(arcs))
+                if rng.random() >= prob[i]:
+                    i = alias[i]
+                t, w = arcs[i]
+                if t[2] != PHI:
+                    return t, w
+                item = draw(t[1])
+                if item is None:
+                    return None
+                if item[0][2] not in self.arcs_by_isym(state):
+                    return item[0], w + item[1]
+            return None
+
         paths = []
-        chart = {}
-        
-        while len(paths) < n and len(h) > 0:
-            accepted = False
-            while len(h) > 0:
-                curr1 = heapq.heappop(h)
-                curr = (curr1[0], curr1[2], curr1[3])
-                #print(curr)
-                if curr[1] in self.final:
-                    accepted = True
+        for i in range(n):
+            q = self.initial
+            weight = 0
+            istr = []
+            ostr = []
+            while q not in self.final:
+                if max_len is not None and len(istr) >= max_len:
+                    q = None
                     break
-                if curr[1] not in self.transitions_by_state:
-                    continue
-                for transition in self.transitions_by_state[curr[1]]:
-                    tost = transition[1]
-                    score = curr[0]+self.transitions[transition]
-                    if tost not in chart:
-                        chart[tost] = []
-                    item = (score, itemcnt, transition[1], curr[2]+[(transition[2], transition[3])])
-                    itemcnt += 1
-                    heapq.heappush(chart[tost], (item))
-                    if item == chart[tost][0]:
-                        heapq.heappush(h, item)
-
-            if accepted:
-                istr = [w[0] for w in curr[2]]
-                ostr = [w[1] for w in curr[2]]
-                while EPS in ostr:
-                    ostr.remove(EPS)
-                while EPS in istr:
-                    istr.remove(EPS)
-                if dups or len(paths) == 0 or not(istr == paths[-1][1] and ostr == paths[-1][2]):
-                    paths.append((curr[0], istr, ostr))
-                for tost in chart:
-                    if len(chart[tost]) > 0:
-                        heapq.heappop(chart[tost])
-                        if len(chart[tost]) > 0:
-                            heapq.heappush(h, chart[tost][0])
-
-            if len(paths) > n:
-                break
-        
+                item = draw(q)
+                if item is None:
+                    q = None
+                    break
+                t, w = item
+                weight += w
+                istr.append(t[2])
+                ostr.append(t[3])
+                q = t[1]
+            if q is not None:
+                paths.append(Path(weight, [sym for sym in istr if sym != EPS],
+                                  [sym for sym in ostr if sym != EPS]))
         return paths
 
     def print_transitions(self):
@@ -175,21 +511,31 @@ class FST(object):
         for t in self.transitions:
             print(t, self.transitions[t])
     
-    def transduce(self, input_symbols, n=300, sep=' ', tostring=False, verbose=1, fstoutput=False):
+    def transduce(self, input_symbols, n=300, sep=' ', tostring=False, verbose=1, fstoutput=False, astar=False,
+                  beam=None, max_active=None, max_expansions=None):
         """
         Runs an input string (list of symbols) through the FST.
         Optionally return a new FST that encodes the output strings,
         or just print the output strings to the console.
         """
         
-        in_fst = linear_chain(input_symbols)
-        c = compose(in_fst, self)
-        sp = c.short_paths(n)
-        if verbose > 0:
-            if sp == None:
+        if fstoutput:
+            in_fst = linear_chain(input_symbols)
+            c = compose(in_fst, self)
+            sp = c.short_paths(n, astar=astar, beam=beam, max_active=max_active,
+                               max_expansions=max_expansions)
+        else:
+            sp = self.decode(input_symbols, n, astar=astar, beam=beam, max_active=max_active,
+                             max_expansions=max_expansions)
+        if verbose > 0 and not sp:
+            if sp is not None and sp.pruned:
+                print('Fail: no output found within the pruning limits')
+            else:
                 print('Fail: input string not in the language')
-                return
+        elif verbose > 0:
             print("Printing at most", n, "output strings.")
+            if sp.pruned:
+                print("The search was pruned; some outputs may be missing.")
             if not tostring:
                 print('Input: ', input_symbols)
             else:
@@ -206,121 +552,3018 @@ class FST(object):
             return c
         return
 
-    def transduce_string(self, input_string, sep=' ', n=300, verbose=1, fstoutput=False):
+    def transduce_string(self, input_string, sep=' ', n=300, verbose=1, fstoutput=False, astar=False,
+                         beam=None, max_active=None, max_expansions=None):
         if sep == '':
             toks = list(input_string)
         else:
             toks = input_string.split(sep=sep)
-        self.transduce(toks, n, sep=sep, tostring=True, verbose=verbose, fstoutput=fstoutput)
+        return self.transduce(toks, n, sep=sep, tostring=True, verbose=verbose, fstoutput=fstoutput, astar=astar,
+                              beam=beam, max_active=max_active, max_expansions=max_expansions)
+
+    def transduce_batch(self, inputs, n=1, sep=' ', workers=None, ordered=True, chunksize=64,
+                        dups=False, astar=False, beam=None, max_active=None, max_expansions=None):
+        """
+        Transduce many inputs with a pool of worker processes.
+        inputs is an iterable of input strings, which are split with
+        sep (into characters if sep is ''), or of lists of symbols.
+        Returns a generator of (index, paths) pairs, where index is
+        the position of the input in inputs and paths is the
+        PathList returned by decode() with the remaining arguments.
+        The pairs come in input order if ordered is True, and as
+        soon as they are ready otherwise.
+
+        workers is the number of processes (by default, one per
+        CPU); with workers=1 everything runs in this process.
+        Inputs are sent to the workers in chunks of chunksize, and
+        only a few chunks per worker are in flight at a time, so
+        inputs can be a stream. Where processes are started by
+        forking, the workers share this FST with the parent;
+        otherwise it is pickled once per worker, never per input.
+        """
+        options = (n, sep, dups, astar, beam, max_active, max_expansions)
+        chunks = _batch_chunks(inputs, chunksize, options)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers == 1:
+            for chunk in chunks:
+                for result in _batch_decode(chunk, self):
+                    yield result
+            return
+
+        global _batch_fst
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+            _batch_fst = self
+            initargs = (None,)
+        else:
+            context = multiprocessing.get_context()
+            initargs = (self,)
+        window = 4 * workers
+        try:
+            with context.Pool(workers, _batch_init, initargs) as pool:
+                if ordered:
+                    pending = deque()
+                    for chunk in chunks:
+                        pending.append(pool.apply_async(_batch_decode, (chunk,)))
+                        if len(pending) >= window:
+                            for result in pending.popleft().get():
+                                yield result
+                    while len(pending) > 0:
+                        for result in pending.popleft().get():
+                            yield result
+                else:
+                    done = queue.Queue()
+                    inflight = 0
+                    for chunk in chunks:
+                        pool.apply_async(_batch_decode, (chunk,), callback=done.put,
+                                         error_callback=done.put)
+                        inflight += 1
+                        while inflight >= window or (inflight > 0 and not done.empty()):
+                            results = done.get()
+                            inflight -= 1
+                            if isinstance(results, BaseException):
+                                raise results
+                            for result in results:
+                                yield result
+                    while inflight > 0:
+                        results = done.get()
+                        inflight -= 1
+                        if isinstance(results, BaseException):
+                            raise results
+                        for result in results:
+                            yield result
+        finally:
+            _batch_fst = None
  
-    def save(self, fname):
-        pickle.dump(self, open(fname, 'wb'))
+    def save(self, fname, binary=False):
+        """
+        Save the FST to a file. By default the FST is pickled. If
+        binary is True, it is frozen and saved in the binary format
+        of ConstFST.save(), which load() can memory-map.
+        """
+        if binary:
+            self.freeze().save(fname, binary=True)
+            return
+        with open(fname, 'wb') as fp:
+            pickle.dump(self, fp)
 
-def load(fname):
-    f = pickle.load(open(fname, 'rb'))
-    return f
+def _distance_to_final(fst):
+    """
+    Compute the shortest distance from each state of fst to a final
+    state, with Dijkstra's algorithm on the reversed transitions.
+    """
+    reverse = defaultdict(list)
+    for q in fst.states:
+        for t, w in fst.arcs(q):
+            reverse[t[1]].append((q, w))
+
+    dist = {}
+    h = []
+    for cnt, s in enumerate(fst.final):
+        h.append((0, cnt, s))
+    cnt = len(h)
+    while len(h) > 0:
+        d, _, q = heapq.heappop(h)
+        if q in dist:
+            continue
+        dist[q] = d
+        for p, w in reverse.get(q, ()):
+            if p not in dist:
+                heapq.heappush(h, (d + w, cnt, p))
+                cnt += 1
+    return dist
 
-def inverted(origf):
+# A path found by a search: its weight, and its input and output
+# symbols without EPS.
+Path = namedtuple('Path', ['weight', 'input', 'output'])
+
+class PathList(list):
     """
-    Create an inverted FST from another FST.
+    The list of paths returned by a search. The pruned attribute
+    is True if the search was pruned, so that the paths may not
+    be the exact shortest paths.
     """
-    newf = FST()
-    newf.initial = origf.initial
-    newf.final = origf.final.copy()
-    for t in origf.transitions:
-        newf.add_transition(t[0], t[1], t[3], t[2], origf.transitions[t])
 
-    return newf
+    pruned = False
 
-def compose(f, g):
+def _backtrace(arena, node):
     """
-    Compose two FSTs, f and g.
+    Rebuild the input and output symbol lists of the path that
+    ends at arena[node], following the back-pointers of the
+    arena items of a search, without EPS.
     """
-                    
-    c = FST()
-    c.states.add((f.initial, g.initial))
-    c.initial = (f.initial, g.initial)
-    a = deque([(f.initial, g.initial)])
+    istr = []
+    ostr = []
+    while node >= 0:
+        back, isym, osym = arena[node]
+        if isym != EPS:
+            istr.append(isym)
+        if osym != EPS:
+            ostr.append(osym)
+        node = back
+    istr.reverse()
+    ostr.reverse()
+    return istr, ostr
 
-    while len(a) > 0:
-        (q1, q2) = a.popleft()
-        
-        for t2 in g.transitions_by_state[q2]:
-            if t2[2] == EPS and ((q1, t2[0]),
-                                (q1, t2[1]),
-                                EPS,
-                                t2[3]) not in c.transitions:
-                c.add_transition((q1, t2[0]),
-                                (q1, t2[1]),
-                                EPS,
-                                t2[3],
-                                g.transitions[t2])
-                a.append((q1, t2[1]))
-
-        for t1 in f.transitions_by_state[q1]:
-            if t1[3] == EPS and ((t1[0], q2),
-                                  (t1[1], q2),
-                                  t1[2],
-                                  EPS) not in c.transitions:
-                c.add_transition((t1[0], q2),
-                                  (t1[1], q2),
-                                  t1[2],
-                                  EPS,
-                                  f.transitions[t1])
-                a.append((t1[1], q2))
-
-        for t1 in f.transitions_by_state[q1]:
-            for t2 in g.transitions_by_state[q2]:
-                if t2[2] == t1[3] and ((t1[0], t2[0]), 
-                                    (t1[1], t2[1]), 
-                                    t1[2], 
-                                    t2[3]) not in c.transitions:
-                    c.add_transition((t1[0], t2[0]), 
-                                    (t1[1], t2[1]), 
-                                    t1[2], 
-                                    t2[3],
-                                    f.transitions[t1] + g.transitions[t2])
-                    a.append((t1[1], t2[1]))
-
-    for ff in f.final:
-        for gf in g.final:
-            if (ff, gf) in c.states:
-                c.set_final((ff, gf))
+def _alias_table(weights):
+    """
+    Build the alias table (Walker's method) to draw one of a list
+    of outcomes with -log probabilities weights, normalized to add
+    up to one, and return it as two lists prob and alias: outcome
+    i is drawn by picking a slot i uniformly, and keeping i with
+    probability prob[i], or taking alias[i] otherwise.
+    """
+    n = len(weights)
+    if n == 0:
+        return [], []
+    wmin = min(weights)
+    p = [math.exp(wmin - w) for w in weights]
+    total = sum(p)
+    scaled = [x * n / total for x in p]
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i in range(n) if scaled[i] < 1]
+    large = [i for i in range(n) if scaled[i] >= 1]
+    while len(small) > 0 and len(large) > 0:
+        i = small.pop()
+        j = large.pop()
+        prob[i] = scaled[i]
+        alias[i] = j
+        scaled[j] -= 1 - scaled[i]
+        if scaled[j] < 1:
+            small.append(j)
+        else:
+            large.append(j)
+    return prob, alias
 
-    c.cleanup()
-    
-    return c
+def _sample_arrays(fst, n, seed, max_len):
+    """
+    FST.sample() for a ConstFST with NumPy: the n paths take one
+    transition at a time, all together, using alias tables laid out
+    like the transition arrays.
+    """
+    tables = fst._cache.get('alias_arrays')
+    if tables is None:
+        prob = np.ones(fst.num_arcs())
+        alias = np.arange(fst.num_arcs())
+        for s in fst.states:
+            start = fst.offsets[s]
+            end = fst.offsets[s + 1]
+            if end > start:
+                p, a = _alias_table([fst.weights[k] for k in range(start, end)])
+                prob[start:end] = p
+                alias[start:end] = np.array(a) + start
+        final = np.zeros(fst.num_states(), dtype=bool)
+        final[list(fst.final)] = True
+        tables = (np.asarray(fst.offsets, dtype=np.int64), prob, alias,
+                  np.asarray(fst.nextstates, dtype=np.int64),
+                  np.asarray(fst.weights, dtype=np.float64), final)
+        fst._cache['alias_arrays'] = tables
+    offsets, prob, alias, nextstates, weights, final = tables
 
-def linear_chain(syms):
+    rng = np.random.default_rng(seed)
+    state = np.full(n, fst.initial, dtype=np.int64)
+    weight = np.zeros(n)
+    alive = ~final[state]
+    dropped = np.zeros(n, dtype=bool)
+    steps = []
+    while alive.any():
+        if max_len is not None and len(steps) >= max_len:
+            dropped |= alive
+            break
+        idx = np.nonzero(alive)[0]
+        q = state[idx]
+        start = offsets[q]
+        degree = offsets[q + 1] - start
+        dead = degree == 0
+        if dead.any():
+            dropped[idx[dead]] = True
+            alive[idx[dead]] = False
+            idx = idx[~dead]
+            q = q[~dead]
+            start = start[~dead]
+            degree = degree[~dead]
+        k = start + (rng.random(len(idx)) * degree).astype(np.int64)
+        k = np.where(rng.random(len(idx)) < prob[k], k, alias[k])
+        state[idx] = nextstates[k]
+        weight[idx] += weights[k]
+        steps.append((idx, k))
+        alive[idx] = ~final[state[idx]]
+
+    # Rebuild the symbol lists of the paths that were not dropped.
+    syms = fst.symbols
+    istrs = [[] for i in range(n)]
+    ostrs = [[] for i in range(n)]
+    for idx, k in steps:
+        for i, kk in zip(idx.tolist(), k.tolist()):
+            isym = syms[fst.ilabels[kk]]
+            osym = syms[fst.olabels[kk]]
+            if isym != EPS:
+                istrs[i].append(isym)
+            if osym != EPS:
+                ostrs[i].append(osym)
+    return [Path(float(weight[i]), istrs[i], ostrs[i]) for i in range(n) if not dropped[i]]
+
+def _search(initial, is_final, arcs, n=1, dups=False, heuristic=None,
+            beam=None, max_active=None, max_expansions=None):
     """
-    Create a linear chain FST, encoding a string.
-    syms is a list containing the symbols of the string.
+    Search for the n shortest paths from state initial to a state
+    for which is_final(state) is True, where arcs(state) returns
+    the (transition, weight) pairs leaving state, and heuristic,
+    if given, returns a lower bound on the distance from a state to
+    a final state, or None if it cannot reach one. See
+    FST.short_paths() for the other arguments and the result.
     """
-    f = FST()
-    curr_state = 0
-    f.set_initial(curr_state)
-    for s in syms:
-        next_state = curr_state + 1
-        f.add_transition(curr_state, next_state, s, s, 0)
-        curr_state = next_state
-    f.set_final(curr_state)
+    if _stats is not None:
+        start = time.perf_counter()
+    paths = PathList()
+    if heuristic is not None and heuristic(initial) is None:
+        return paths
+
+    # Best first search, from the initial state to any of
+    # the final states, in which each state is expanded at most
+    # n times: the n shortest paths never need more than the n
+    # shortest prefixes that end in a given state.
+    #
+    # A heap item is (priority, itemcnt, score, state, pos, back,
+    # isym, osym, ikey, okey), where priority is the score plus,
+    # for A* search, the distance from state to a final state,
+    # and pos is the number of input symbols read so far.
+    # Expanded items are stored in the arena as
+    # (back, isym, osym), where back is the arena index of the
+    # item they extend, and the symbol lists are only rebuilt
+    # for accepted paths. Unless dups is True, ikey and okey are
+    # the nodes of the input and output strings so far (without
+    # EPS) in a trie of strings, so that items with the same
+    # strings in the same state are expanded only once.
+    arena = []
+    trie = {}
+    expanded = set()
+    accepted = set()
+    pops = defaultdict(int)
+    best = {}
+    active = defaultdict(int)
+
+    h = [(0, 0, 0, initial, 0, -1, EPS, EPS, 0, 0)]
+    best[0] = 0
+    itemcnt = 1
+    duplicates = 0
+
+    while len(paths) < n and len(h) > 0:
+        if max_expansions is not None and len(arena) >= max_expansions:
+            paths.pruned = True
+            break
+        (_, _, score, q, pos, back, isym, osym,
+         ikey, okey) = heapq.heappop(h)
+        if pops[q] >= n:
+            continue
+        # Epsilon moves do not read input, so a path extended by one
+        # keeps the beam decision taken when it read its last symbol.
+        if beam is not None and isym != EPS and score > best[pos] + beam:
+            paths.pruned = True
+            continue
+        if not dups:
+            if (q, ikey, okey) in expanded:
+                duplicates += 1
+                continue
+            expanded.add((q, ikey, okey))
+        if max_active is not None:
+            if active[pos] >= max_active:
+                paths.pruned = True
+                continue
+            active[pos] += 1
+        pops[q] += 1
+        node = len(arena)
+        arena.append((back, isym, osym))
+
+        if is_final(q) and (dups or (ikey, okey) not in accepted):
+            accepted.add((ikey, okey))
+            istr, ostr = _backtrace(arena, node)
+            paths.append(Path(score, istr, ostr))
+
+        for t, w in arcs(q):
+            if pops[t[1]] >= n:
+                continue
+            nscore = score + w
+            priority = nscore
+            if heuristic is not None:
+                d = heuristic(t[1])
+                if d is None:
+                    continue
+                priority += d
+            npos = pos
+            if t[2] != EPS:
+                npos += 1
+            if beam is not None and t[2] != EPS:
+                if npos not in best or nscore < best[npos]:
+                    best[npos] = nscore
+                elif nscore > best[npos] + beam:
+                    paths.pruned = True
+                    continue
+            nikey = ikey
+            nokey = okey
+            if not dups:
+                if t[2] != EPS:
+                    nikey = trie.setdefault((ikey, t[2]), len(trie) + 1)
+                if t[3] != EPS:
+                    nokey = trie.setdefault((okey, t[3]), len(trie) + 1)
+            heapq.heappush(h, (priority, itemcnt, nscore, t[1], npos,
+                               node, t[2], t[3], nikey, nokey))
+            itemcnt += 1
+
+    if _stats is not None:
+        _stats['search.calls'] += 1
+        _stats['search.time'] += time.perf_counter() - start
+        _stats['search.pushes'] += itemcnt
+        _stats['search.pops'] += itemcnt - len(h)
+        _stats['search.expansions'] += len(arena)
+        _stats['search.duplicates'] += duplicates
+        _stats['search.states'] += sum(1 for cnt in pops.values() if cnt > 0)
+        _stats['search.trie_nodes'] += len(trie)
+        _stats['search.paths'] += len(paths)
+    return paths
+
+class _ReadOnlyFST(FST):
+    """
+    Base class for FSTs that are only read through initial, final
+    and arcs(), and cannot be modified. The transitions and
+    transitions_by_state attributes are read-only views built
+    on arcs().
+    """
+
+    @property
+    def transitions(self):
+        return _TransitionsView(self)
+
+    @property
+    def transitions_by_state(self):
+        return _TransitionsByStateView(self)
+
+    def _has_arcs(self, state):
+        return len(self.arcs(state)) > 0
+
+    def num_states(self):
+        return len(self.states)
+
+    def num_arcs(self):
+        return sum(len(self.arcs(s)) for s in self.states)
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s is immutable' % type(self).__name__)
+
+    add_transition = _immutable
+    add_transitions = _immutable
+    rm_transition = _immutable
+    cleanup = _immutable
+    set_initial = _immutable
+    set_final = _immutable
+    unset_final = _immutable
+
+class ConstFST(_ReadOnlyFST):
+    """
+    An immutable FST with a compact, array-backed representation,
+    usually created with FST.freeze().
+
+    States are the integers 0..num_states-1, and symbols are
+    interned in the symbol table self.symbols, where EPS always
+    has id 0. The transitions leaving state s are stored at
+    positions offsets[s] to offsets[s+1] of the parallel arrays
+    nextstates, ilabels, olabels and weights.
+
+    A ConstFST can be used wherever an FST is read (compose,
+    short_paths, transduce, inverted), and its transitions are
+    presented as the usual (state1, state2, isym, osym) tuples.
+    """
+
+    def __init__(self, symbols, offsets, nextstates, ilabels, olabels,
+                 weights, initial=None, final=(), state_names=None):
+        self.symbols = symbols
+        self.symbol_ids = dict((sym, i) for i, sym in enumerate(symbols))
+        self.offsets = offsets
+        self.nextstates = nextstates
+        self.ilabels = ilabels
+        self.olabels = olabels
+        self.weights = weights
+        # States are plain ints, also when given as NumPy integers.
+        self.initial = None if initial is None else int(initial)
+        self.final = set(int(s) for s in final)
+        self.state_names = state_names
+        self._reset_caches()
+
+    @property
+    def states(self):
+        return range(len(self.offsets) - 1)
+
+    def num_states(self):
+        return len(self.offsets) - 1
+
+    def num_arcs(self):
+        return len(self.nextstates)
+
+    def arcs(self, state):
+        syms = self.symbols
+        nextstates = self.nextstates
+        ilabels = self.ilabels
+        olabels = self.olabels
+        weights = self.weights
+        return [((state, nextstates[k], syms[ilabels[k]], syms[olabels[k]]),
+                 weights[k])
+                for k in range(self.offsets[state], self.offsets[state + 1])]
+
+    def _has_arcs(self, state):
+        offsets = self.offsets
+        return (isinstance(state, int) and 0 <= state < len(offsets) - 1 and
+                offsets[state] < offsets[state + 1])
+
+    def arcs_by_isym(self, state):
+        """
+        Return the transitions leaving state indexed by input symbol,
+        as a read-only mapping like the dict of FST.arcs_by_isym().
+        A ConstFST never changes, so a dict per state would be kept
+        for good; instead, symbols are looked up by binary search in
+        a copy of the labels sorted within each state, built once.
+        """
+        return _ArcIndex(self, state, *self._label_order('ilabels'))
+
+    def arcs_by_osym(self, state):
+        """
+        Same as arcs_by_isym(), but indexed by output symbol.
+        """
+        return _ArcIndex(self, state, *self._label_order('olabels'))
+
+    def _label_order(self, name):
+        """
+        Return the positions of the transitions sorted by state and
+        by the labels of the array name (ilabels or olabels), these
+        labels in that order, and the number of distinct labels
+        leaving each state, as three arrays.
+        """
+        result = self._cache.get(name)
+        if result is not None:
+            return result
+        offsets = self.offsets
+        nstates = len(offsets) - 1
+        if np is not None:
+            labels = np.frombuffer(getattr(self, name), dtype=np.int32)
+            src = np.repeat(np.arange(nstates), np.diff(np.frombuffer(offsets, dtype=np.int64)))
+            order = np.lexsort((labels, src))
+            labels = labels[order]
+            first = np.ones(len(labels), dtype=bool)
+            first[1:] = labels[1:] != labels[:-1]
+            first[1:] |= src[1:] != src[:-1]
+            counts = np.bincount(src[first], minlength=nstates)
+            result = (array('q', order.astype(np.int64).tobytes()),
+                      array('i', labels.tobytes()),
+                      array('q', counts.astype(np.int64).tobytes()))
+        else:
+            labels = getattr(self, name)
+            order = array('q')
+            counts = array('q', bytes(8 * nstates))
+            for s in range(nstates):
+                arcs = sorted(range(offsets[s], offsets[s + 1]), key=labels.__getitem__)
+                order.extend(arcs)
+                counts[s] = len(set(labels[k] for k in arcs))
+            result = (order, array('i', (labels[k] for k in order)), counts)
+        self._cache[name] = result
+        return result
+
+    def freeze(self):
+        return self
+
+    def save(self, fname, binary=True):
+        """
+        Save the FST to a file, by default in a versioned binary
+        format: a header, the symbol table, the final states, the
+        transition arrays and the state names. Use load() with
+        mmap=True to use the arrays in place, without copying them.
+        All symbols must be strings. If binary is False, the FST is
+        pickled instead.
+        """
+        if not binary:
+            with open(fname, 'wb') as fp:
+                pickle.dump(self, fp)
+            return
+        _save_binary(self, fname)
+
+    def __getstate__(self):
+        # Arrays that are views of a memory-mapped file are copied.
+        state = FST.__getstate__(self)
+        for key in ('offsets', 'nextstates', 'ilabels', 'olabels', 'weights'):
+            if isinstance(state[key], memoryview):
+                a = array(state[key].format)
+                a.frombytes(state[key].cast('B'))
+                state[key] = a
+        return state
+
+    def thaw(self):
+        """
+        Return a mutable FST copy, using the original state names
+        if they are known.
+        """
+        names = self.state_names
+        if names is None:
+            names = self.states
+        f = FST()
+        if self.initial is not None:
+            f.set_initial(names[self.initial])
+        for s in self.final:
+            f.set_final(names[s])
+        for s in self.states:
+            for t, w in self.arcs(s):
+                f.add_transition(names[t[0]], names[t[1]], t[2], t[3], w)
+        return f
+
+class _ArcIndex(object):
+    """
+    The transitions leaving a state of a ConstFST, indexed by input
+    or output symbol: a read-only mapping from each symbol to the
+    list of (transition, weight) pairs with that symbol, built when
+    it is looked up. order, labels and counts are the arrays of
+    ConstFST._label_order().
+    """
+
+    def __init__(self, fst, state, order, labels, counts):
+        self.fst = fst
+        self.state = state
+        self.order = order
+        self.labels = labels
+        self.counts = counts
+        if fst._has_arcs(state):
+            self.lo = fst.offsets[state]
+            self.hi = fst.offsets[state + 1]
+        else:
+            self.lo = self.hi = 0
+
+    def _range(self, sym):
+        i = self.fst.symbol_ids.get(sym)
+        if i is None:
+            return self.lo, self.lo
+        lo = bisect.bisect_left(self.labels, i, self.lo, self.hi)
+        return lo, bisect.bisect_right(self.labels, i, lo, self.hi)
+
+    def get(self, sym, default=None):
+        lo, hi = self._range(sym)
+        if lo == hi:
+            return default
+        f = self.fst
+        syms = f.symbols
+        result = []
+        for j in range(lo, hi):
+            k = self.order[j]
+            result.append(((self.state, f.nextstates[k], syms[f.ilabels[k]], syms[f.olabels[k]]),
+                           f.weights[k]))
+        return result
+
+    def __getitem__(self, sym):
+        arcs = self.get(sym)
+        if arcs is None:
+            raise KeyError(sym)
+        return arcs
+
+    def __contains__(self, sym):
+        lo, hi = self._range(sym)
+        return lo < hi
+
+    def __iter__(self):
+        syms = self.fst.symbols
+        labels = self.labels
+        j = self.lo
+        while j < self.hi:
+            yield syms[labels[j]]
+            j = bisect.bisect_right(labels, labels[j], j, self.hi)
+
+    def __len__(self):
+        if self.lo == self.hi:
+            return 0
+        return self.counts[self.state]
+
+class _TransitionsView(object):
+    """
+    Read-only view of the transitions of a _ReadOnlyFST, as a
+    mapping from transition tuples to weights.
+    """
+
+    def __init__(self, fst):
+        self.fst = fst
+
+    def __len__(self):
+        return self.fst.num_arcs()
+
+    def __iter__(self):
+        for s in self.fst.states:
+            for t, w in self.fst.arcs(s):
+                yield t
+
+    def items(self):
+        for s in self.fst.states:
+            for item in self.fst.arcs(s):
+                yield item
+
+    def get(self, t, default=None):
+        if t[0] in self.fst.transitions_by_state:
+            for t2, w in self.fst.arcs(t[0]):
+                if t2 == t:
+                    return w
+        return default
+
+    def __contains__(self, t):
+        return self.get(t) is not None
+
+    def __getitem__(self, t):
+        w = self.get(t)
+        if w is None:
+            raise KeyError(t)
+        return w
+
+class _TransitionsByStateView(object):
+    """
+    Read-only view of the transitions of a _ReadOnlyFST, indexed
+    by their source state.
+    """
+
+    def __init__(self, fst):
+        self.fst = fst
+
+    def __iter__(self):
+        for s in self.fst.states:
+            if self.fst._has_arcs(s):
+                yield s
+
+    def get(self, s, default=None):
+        if s in self:
+            return set(t for t, w in self.fst.arcs(s))
+        return default
+
+    def __contains__(self, s):
+        return self.fst._has_arcs(s)
+
+    def __getitem__(self, s):
+        return self.get(s, set())
+
+# The FST used by transduce_batch() in a worker process.
+_batch_fst = None
+
+def _batch_init(fst):
+    global _batch_fst
+    if fst is not None:
+        _batch_fst = fst
+
+def _batch_chunks(inputs, chunksize, options):
+    """
+    Group inputs into (start index, inputs, options) chunks.
+    """
+    chunk = []
+    start = 0
+    for i, item in enumerate(inputs):
+        if len(chunk) == 0:
+            start = i
+        chunk.append(item)
+        if len(chunk) >= chunksize:
+            yield (start, chunk, options)
+            chunk = []
+    if len(chunk) > 0:
+        yield (start, chunk, options)
+
+def _batch_decode(chunk, fst=None):
+    """
+    Decode a chunk of inputs for transduce_batch(), returning a list
+    of (index, paths) pairs.
+    """
+    if fst is None:
+        fst = _batch_fst
+    start, inputs, options = chunk
+    n, sep, dups, astar, beam, max_active, max_expansions = options
+    results = []
+    for i, item in enumerate(inputs):
+        if isinstance(item, str):
+            if sep == '':
+                item = list(item)
+            else:
+                item = item.split(sep)
+        paths = fst.decode(item, n, dups=dups, astar=astar, beam=beam,
+                           max_active=max_active, max_expansions=max_expansions)
+        results.append((start + i, paths))
+    return results
+
+# The binary file format of ConstFST.save(). All numbers are little
+# endian. The header is followed by these sections, each starting at
+# a multiple of 8 bytes:
+#   symbol offsets  int64[num_symbols + 1], into the symbol text
+#   symbol text     the UTF-8 encoded symbols, one after the other
+#   final states    int32[num_final]
+#   offsets         int64[num_states + 1]
+#   nextstates      int32[num_arcs]
+#   ilabels         int32[num_arcs]
+#   olabels         int32[num_arcs]
+#   weights         float64[num_arcs]
+# and then, if flags has _TEXT_STATE_NAMES, the state names as text,
+# like the symbols:
+#   name offsets    int64[num_states + 1], into the name text
+#   name text       the UTF-8 encoded state names
+# or, if flags has _HAS_STATE_NAMES, a pickled list of state names
+# (used when they are not all strings).
+_MAGIC = b'FSTB'
+_VERSION = 2
+# The versions that load() reads: version 1 files have no text
+# state names.
+_VERSIONS = (1, 2)
+_HAS_STATE_NAMES = 1
+_TEXT_STATE_NAMES = 2
+# magic, version, flags, num_states, num_arcs, num_symbols, num_final,
+# initial state (-1 for none)
+_HEADER = struct.Struct('<4sIIqqqqq')
+
+def _align(pos):
+    return (pos + 7) // 8 * 8
+
+def _save_binary(f, fname):
+    """
+    Save ConstFST f in the binary format.
+    """
+    symbol_text = []
+    symbol_offsets = array('q', [0])
+    for sym in f.symbols:
+        if not isinstance(sym, str):
+            raise ValueError('binary FST files need string symbols, not %r' % (sym,))
+        symbol_text.append(sym.encode('utf-8'))
+        symbol_offsets.append(symbol_offsets[-1] + len(symbol_text[-1]))
+
+    flags = 0
+    names = f.state_names
+    if names is not None:
+        if (len(names) == f.num_states() and
+                all(isinstance(name, str) for name in names)):
+            flags |= _TEXT_STATE_NAMES
+            name_text = []
+            name_offsets = array('q', [0])
+            for name in names:
+                name_text.append(name.encode('utf-8'))
+                name_offsets.append(name_offsets[-1] + len(name_text[-1]))
+        else:
+            flags |= _HAS_STATE_NAMES
+    initial = -1 if f.initial is None else f.initial
+    header = _HEADER.pack(_MAGIC, _VERSION, flags, f.num_states(), f.num_arcs(),
+                          len(f.symbols), len(f.final), initial)
+
+    with open(fname, 'wb') as fp:
+        _write_section(fp, header, None)
+        _write_section(fp, symbol_offsets, 'q')
+        _write_section(fp, b''.join(symbol_text), None)
+        _write_section(fp, sorted(f.final), 'i')
+        _write_section(fp, f.offsets, 'q')
+        _write_section(fp, f.nextstates, 'i')
+        _write_section(fp, f.ilabels, 'i')
+        _write_section(fp, f.olabels, 'i')
+        _write_section(fp, f.weights, 'd')
+        if flags & _TEXT_STATE_NAMES:
+            _write_section(fp, name_offsets, 'q')
+            _write_section(fp, b''.join(name_text), None)
+        elif flags & _HAS_STATE_NAMES:
+            pickle.dump(list(names), fp)
+
+def _write_section(fp, data, typecode):
+    """
+    Write a section of a binary FST file: an array of numbers of the
+    given typecode, or bytes if typecode is None. The file position
+    is then padded to a multiple of 8.
+    """
+    if typecode is not None:
+        if not (isinstance(data, array) and data.typecode == typecode):
+            a = array(typecode)
+            if isinstance(data, memoryview):
+                a.frombytes(data.cast('B'))
+            else:
+                a.extend(data)
+            data = a
+        if sys.byteorder == 'big':
+            data = array(typecode, data)
+            data.byteswap()
+    fp.write(data)
+    pos = fp.tell()
+    fp.write(bytes(_align(pos) - pos))
+
+def _load_binary(fname, use_mmap):
+    """
+    Load a ConstFST from a binary file. If use_mmap is True, the file
+    is memory-mapped and the transition arrays are views of it.
+    """
+    with open(fname, 'rb') as fp:
+        if use_mmap:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buf = fp.read()
+    view = memoryview(buf)
+    (magic, version, flags, num_states, num_arcs, num_symbols, num_final,
+     initial) = _HEADER.unpack_from(view, 0)
+    if magic != _MAGIC:
+        raise ValueError('%s is not a binary FST file' % fname)
+    if version not in _VERSIONS:
+        raise ValueError('%s has unsupported binary FST version %d' % (fname, version))
+
+    pos = _align(_HEADER.size)
+    def section(typecode, count):
+        nonlocal pos
+        size = count * array(typecode).itemsize
+        data = view[pos:pos + size]
+        pos = _align(pos + size)
+        if use_mmap and sys.byteorder == 'little':
+            return data.cast(typecode)
+        a = array(typecode)
+        a.frombytes(data)
+        if sys.byteorder == 'big':
+            a.byteswap()
+        return a
+
+    symbol_offsets = section('q', num_symbols + 1)
+    text = bytes(view[pos:pos + symbol_offsets[-1]])
+    pos = _align(pos + symbol_offsets[-1])
+    symbols = [text[symbol_offsets[i]:symbol_offsets[i + 1]].decode('utf-8')
+               for i in range(num_symbols)]
+    final = section('i', num_final)
+    offsets = section('q', num_states + 1)
+    nextstates = section('i', num_arcs)
+    ilabels = section('i', num_arcs)
+    olabels = section('i', num_arcs)
+    weights = section('d', num_arcs)
+    state_names = None
+    if flags & _TEXT_STATE_NAMES:
+        name_offsets = section('q', num_states + 1)
+        text = view[pos:pos + name_offsets[-1]]
+        if not use_mmap:
+            text = bytes(text)
+        state_names = _StateNames(name_offsets, text)
+    elif flags & _HAS_STATE_NAMES:
+        state_names = pickle.loads(view[pos:])
+    if initial < 0:
+        initial = None
+    return ConstFST(symbols, offsets, nextstates, ilabels, olabels, weights,
+                    initial, list(final), state_names)
+
+class _StateNames(object):
+    """
+    The state names of a ConstFST loaded from a binary file, as a
+    read-only sequence of strings: offsets index the UTF-8 encoded
+    names in text, and a name is only decoded when it is looked up,
+    so that loading takes no time per name, and a memory-mapped file
+    shares the names between the processes that load it.
+    """
+
+    def __init__(self, offsets, text):
+        self.offsets = offsets
+        self.text = text
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = range(len(self))[i]
+        return str(self.text[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, _StateNames)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __getstate__(self):
+        # Views of a memory-mapped file are copied.
+        offsets = self.offsets
+        if isinstance(offsets, memoryview):
+            offsets = array('q')
+            offsets.frombytes(self.offsets.cast('B'))
+        return {'offsets': offsets, 'text': bytes(self.text)}
+
+def load(fname, mmap=False):
+    """
+    Load an FST saved with save(). Pickled FSTs are unpickled.
+    Binary files are loaded as a ConstFST. If mmap is True, a binary
+    file is memory-mapped and its transition arrays are used in
+    place, so that loading takes time independent of the size of the
+    FST, and processes that load the same file share its pages. State
+    names that are strings are decoded when they are looked up.
+    """
+    with open(fname, 'rb') as fp:
+        magic = fp.read(len(_MAGIC))
+    if magic == _MAGIC:
+        return _load_binary(fname, mmap)
+    with open(fname, 'rb') as fp:
+        f = pickle.load(fp)
     return f
 
-def linear_chain_from_string(mystr, sep=''):
+def from_arrays(src, dst, ilabels, olabels, weights, symbols, initial=0, final=(),
+                num_states=None, state_names=None):
     """
-    Create a linear chain FST, encoding a string.
-    mystr is a string, and sep is the separator. If no
-    separator is provided, the string is split into
-    characters.
+    Build a ConstFST from parallel sequences of transitions, with
+    source state, destination state, input and output symbol ids
+    and weight of each transition: lists, arrays or NumPy arrays.
+    States are integers, and symbol ids index symbols, where EPS
+    must have id 0. The transitions are grouped by source state
+    with a counting sort, keeping their order within each state,
+    so building an FST this way takes a fraction of the time of
+    calling add_transition() for each one. num_states is one more
+    than the largest state id by default.
     """
-    if sep == '':
-        toks = list(mystr)
-    else:
-        toks = mystr.split(sep=sep)
+    narcs = len(src)
+    if not (len(dst) == len(ilabels) == len(olabels) == len(weights) == narcs):
+        raise ValueError('the transition arrays must have the same length')
+    if len(symbols) == 0 or symbols[0] != EPS:
+        raise ValueError('symbol id 0 must be EPS')
+    symbols = list(symbols)
 
-    return linear_chain(toks)
+    if np is not None:
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        if num_states is None:
+            num_states = 0
+            if narcs > 0:
+                num_states = int(max(src.max(), dst.max())) + 1
+            for s in list(final) + [initial]:
+                if s is not None:
+                    num_states = max(num_states, s + 1)
+        counts = np.bincount(src, minlength=num_states)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        order = np.argsort(src, kind='stable')
+
+        def column(values, typecode, dtype):
+            return array(typecode, np.asarray(values, dtype=dtype)[order].tobytes())
+
+        return ConstFST(symbols, array('q', offsets.astype(np.int64).tobytes()),
+                        column(dst, 'i', np.int32), column(ilabels, 'i', np.int32),
+                        column(olabels, 'i', np.int32), column(weights, 'd', np.float64),
+                        initial, final, state_names)
+
+    if num_states is None:
+        num_states = max(max(src, default=-1), max(dst, default=-1)) + 1
+        for s in list(final) + [initial]:
+            if s is not None:
+                num_states = max(num_states, s + 1)
+    offsets = array('q', [0] * (num_states + 1))
+    for s in src:
+        offsets[s + 1] += 1
+    for i in range(num_states):
+        offsets[i + 1] += offsets[i]
+    # The position of each transition in the sorted arrays.
+    pos = array('q', offsets[:-1])
+    order = array('q', [0] * narcs)
+    for k, s in enumerate(src):
+        order[pos[s]] = k
+        pos[s] += 1
+    return ConstFST(symbols, offsets,
+                    array('i', (dst[k] for k in order)),
+                    array('i', (ilabels[k] for k in order)),
+                    array('i', (olabels[k] for k in order)),
+                    array('d', (weights[k] for k in order)),
+                    initial, final, state_names)
+
+def read_att(fname, isymbols=None, osymbols=None, acceptor=False):
+    """
+    Read an FST in the AT&T text format of OpenFst (fstprint,
+    fstcompile) and return it as a ConstFST. Each line is a
+    transition, "src dst isym osym [weight]", or a final state,
+    "state [weight]"; the source state of the first line is the
+    initial state, and states are integers. If acceptor is True,
+    transitions have a single symbol, "src dst sym [weight]", used
+    as both input and output symbol.
+
+    isymbols and osymbols are optional symbol table files, with a
+    "symbol id" line per symbol. Labels that are not symbols of
+    the table are read as ids, so that both the output of fstprint
+    with and without symbol tables can be read. The symbol with id
+    0 is EPS, whatever its name (OpenFst usually calls it
+    <epsilon>). Without a symbol table, labels are read as symbols
+    as they are, except 0, which is EPS as in the numeric output of
+    fstprint.
+
+    The file is read line by line into arrays, so it can be larger
+    than the memory taken by the FST itself. Since an FST has no
+    final weights, a final state with a weight gets an EPS
+    transition with that weight to a new final state.
+    """
+    ilookup = _att_labels(isymbols)
+    olookup = _att_labels(osymbols)
+    symbols = [EPS]
+    symbol_ids = {EPS: 0}
+    src = array('i')
+    dst = array('i')
+    ilabels = array('i')
+    olabels = array('i')
+    weights = array('d')
+    final = []
+    final_weights = []
+    initial = None
+
+    def intern(label, lookup):
+        sym = lookup(label)
+        i = symbol_ids.get(sym)
+        if i is None:
+            i = symbol_ids[sym] = len(symbols)
+            symbols.append(sym)
+        return i
+
+    with open(fname, 'r', encoding='utf-8') as fp:
+        for lineno, line in enumerate(fp, 1):
+            fields = line.split()
+            if len(fields) == 0:
+                continue
+            try:
+                if len(fields) <= 2:
+                    s = int(fields[0])
+                    w = float(fields[1]) if len(fields) == 2 else 0.0
+                    final.append(s)
+                    final_weights.append(w)
+                elif acceptor and len(fields) <= 4:
+                    s = int(fields[0])
+                    src.append(s)
+                    dst.append(int(fields[1]))
+                    i = intern(fields[2], ilookup)
+                    ilabels.append(i)
+                    olabels.append(i)
+                    weights.append(float(fields[3]) if len(fields) == 4 else 0.0)
+                elif not acceptor and 4 <= len(fields) <= 5:
+                    s = int(fields[0])
+                    src.append(s)
+                    dst.append(int(fields[1]))
+                    ilabels.append(intern(fields[2], ilookup))
+                    olabels.append(intern(fields[3], olookup))
+                    weights.append(float(fields[4]) if len(fields) == 5 else 0.0)
+                else:
+                    raise ValueError('wrong number of fields')
+            except (ValueError, KeyError) as e:
+                raise ValueError('%s:%d: bad line %r (%s)' % (fname, lineno, line.rstrip('\n'), e))
+            if initial is None:
+                initial = s
+
+    num_states = max(max(src, default=-1), max(dst, default=-1), max(final, default=-1),
+                     -1 if initial is None else initial) + 1
+    if any(w != 0 for w in final_weights):
+        superfinal = num_states
+        num_states += 1
+        for s, w in zip(final, final_weights):
+            src.append(s)
+            dst.append(superfinal)
+            ilabels.append(0)
+            olabels.append(0)
+            weights.append(w)
+        final = [superfinal]
+    return from_arrays(src, dst, ilabels, olabels, weights, symbols, initial, final, num_states)
+
+def _att_labels(fname):
+    """
+    Return a function that maps a label of an AT&T file to its
+    symbol, with the symbol table in file fname if it is given.
+    The symbol with id 0, whatever its name, and label 0 without a
+    symbol table are EPS.
+    """
+    if fname is None:
+        return lambda label: EPS if label == '0' else label
+    symbols = {EPS: EPS}
+    names = {}
+    with open(fname, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            fields = line.split()
+            if len(fields) == 0:
+                continue
+            if len(fields) != 2:
+                raise ValueError('%s: bad symbol table line %r' % (fname, line.rstrip('\n')))
+            sym = EPS if fields[1] == '0' else fields[0]
+            symbols[fields[0]] = sym
+            names[fields[1]] = sym
 
-def main():
+    def lookup(label):
+        sym = symbols.get(label)
+        if sym is None:
+            sym = names[label]
+        return sym
+    return lookup
+
+def write_att(fst, fname, isymbols=None, osymbols=None):
+    """
+    Write an FST in the AT&T text format read by read_att() and by
+    OpenFst's fstcompile, one line per transition and per final
+    state, as the transitions are read, so that large and lazy
+    FSTs are written without copying them. States are numbered
+    from 0, the initial state, in breadth-first order, and only
+    the states reachable from the initial state are written.
+    Symbols are written as they are, so they must be strings
+    without whitespace; if isymbols or osymbols are given, the
+    input or output symbol table is also written to these files,
+    with EPS as id 0. Without a symbol table, the symbol 0 would be
+    read back as EPS, so it cannot be written.
+    """
+    itable = {EPS: 0}
+    otable = {EPS: 0}
+    if fst.initial is None:
+        open(fname, 'w', encoding='utf-8').close()
+    else:
+        ids = {fst.initial: 0}
+        a = deque([fst.initial])
+        with open(fname, 'w', encoding='utf-8') as fp:
+            while len(a) > 0:
+                q = a.popleft()
+                lines = []
+                for t, w in fst.arcs(q):
+                    if t[1] not in ids:
+                        ids[t[1]] = len(ids)
+                        a.append(t[1])
+                    for sym, table, tablefile in ((t[2], itable, isymbols),
+                                                  (t[3], otable, osymbols)):
+                        if sym not in table:
+                            if not isinstance(sym, str):
+                                raise ValueError('AT&T files need string symbols, not %r'
+                                                 % (sym,))
+                            if sym.split() != [sym] or (sym == '0' and tablefile is None):
+                                raise ValueError('symbol %r cannot be written in the AT&T format'
+                                                 % (sym,))
+                            table[sym] = len(table)
+                    if w == 0:
+                        lines.append('%d\t%d\t%s\t%s\n' % (ids[q], ids[t[1]], t[2], t[3]))
+                    else:
+                        lines.append('%d\t%d\t%s\t%s\t%r\n' % (ids[q], ids[t[1]], t[2], t[3],
+                                                                 float(w)))
+                if q in fst.final:
+                    lines.append('%d\n' % ids[q])
+                fp.writelines(lines)
+
+    for table, tname in ((itable, isymbols), (otable, osymbols)):
+        if tname is not None:
+            with open(tname, 'w', encoding='utf-8') as fp:
+                for sym, i in table.items():
+                    fp.write('%s\t%d\n' % (sym, i))
+
+class MappedFST(_ReadOnlyFST):
+    """
+    A read-only view of another FST with its transitions mapped on
+    the fly, without copying them: labels is None to keep the
+    labels, 'invert' to swap input and output symbols, 'input' to
+    copy input symbols to the output (projection on the input
+    side), or 'output' to copy output symbols to the input; and
+    each weight w becomes w * scale + shift. Creating a view takes
+    constant time, and its transitions are only mapped when they
+    are read, so it can be composed and searched like any FST. The
+    view reflects later changes to the FST it wraps: its label
+    indexes map those of that FST, and nothing computed over the
+    view, such as distance_to_final(), is cached on it.
+    """
+
+    def __init__(self, fst, labels=None, scale=1, shift=0):
+        if labels not in (None, 'invert', 'input', 'output'):
+            raise ValueError('unknown label mapping: %r' % (labels,))
+        self.fst = fst
+        self.labels = labels
+        self.scale = scale
+        self.shift = shift
+
+    def _reset_caches(self):
+        pass
+
+    @property
+    def _cache(self):
+        # A new table each time, so that what FST methods store in
+        # it is dropped.
+        return {}
+
+    @property
+    def initial(self):
+        return self.fst.initial
+
+    @property
+    def final(self):
+        return self.fst.final
+
+    @property
+    def states(self):
+        return self.fst.states
+
+    def num_states(self):
+        return self.fst.num_states() if isinstance(self.fst, _ReadOnlyFST) else len(self.fst.states)
+
+    def num_arcs(self):
+        return self.fst.num_arcs() if isinstance(self.fst, _ReadOnlyFST) else len(self.fst.transitions)
+
+    def arcs(self, state):
+        return self._map(self.fst.arcs(state))
+
+    def arcs_by_isym(self, state):
+        if self.labels in ('invert', 'output'):
+            return _MappedIndex(self, self.fst.arcs_by_osym(state))
+        return _MappedIndex(self, self.fst.arcs_by_isym(state))
+
+    def arcs_by_osym(self, state):
+        if self.labels in ('invert', 'input'):
+            return _MappedIndex(self, self.fst.arcs_by_isym(state))
+        return _MappedIndex(self, self.fst.arcs_by_osym(state))
+
+    def _map(self, arcs):
+        """
+        Return the (transition, weight) pairs of the FST this view
+        wraps, mapped.
+        """
+        scale = self.scale
+        shift = self.shift
+        if scale != 1 or shift != 0:
+            arcs = [(t, w * scale + shift) for t, w in arcs]
+        labels = self.labels
+        if labels == 'invert':
+            return [((t[0], t[1], t[3], t[2]), w) for t, w in arcs]
+        if labels == 'input':
+            return [((t[0], t[1], t[2], t[2]), w) for t, w in arcs]
+        if labels == 'output':
+            return [((t[0], t[1], t[3], t[3]), w) for t, w in arcs]
+        return arcs
+
+    def distance_to_final(self):
+        """
+        Return the distances to a final state, from the FST this
+        view wraps if the weights are not changed, or computed
+        again on each call otherwise.
+        """
+        if self.scale == 1 and self.shift == 0:
+            return self.fst.distance_to_final()
+        return _distance_to_final(self)
+
+    def materialize(self):
+        """
+        Return a copy of the view that no longer depends on the FST
+        it wraps: a ConstFST if that FST is a ConstFST (sharing its
+        arrays where they are not changed), or an FST with the same
+        state names otherwise.
+        """
+        f = self.fst
+        if isinstance(f, ConstFST):
+            ilabels, olabels = f.ilabels, f.olabels
+            if self.labels == 'invert':
+                ilabels, olabels = f.olabels, f.ilabels
+            elif self.labels == 'input':
+                olabels = f.ilabels
+            elif self.labels == 'output':
+                ilabels = f.olabels
+            weights = f.weights
+            if self.scale != 1 or self.shift != 0:
+                weights = array('d', [w * self.scale + self.shift for w in f.weights])
+            return ConstFST(f.symbols, f.offsets, f.nextstates, ilabels, olabels,
+                            weights, f.initial, f.final, f.state_names)
+
+        newf = FST()
+        if self.initial is not None:
+            newf.set_initial(self.initial)
+        for s in self.final:
+            newf.set_final(s)
+        # Only the expanded states of a lazy FST are listed, so the
+        # states reachable from them are copied as well.
+        a = deque()
+        if self.initial is not None:
+            a.append(self.initial)
+        a.extend(s for s in self.states if s != self.initial)
+        visited = set(a)
+        while len(a) > 0:
+            q = a.popleft()
+            # A projection can map several transitions to the same
+            # one, which keeps the best of their weights.
+            arcs = {}
+            for t, w in self.arcs(q):
+                if t not in arcs or w < arcs[t]:
+                    arcs[t] = w
+            for t, w in arcs.items():
+                newf.add_transition(t[0], t[1], t[2], t[3], w)
+                if t[1] not in visited:
+                    visited.add(t[1])
+                    a.append(t[1])
+        return newf
+
+class _MappedIndex(object):
+    """
+    A label index of a MappedFST: the arcs_by_isym() or
+    arcs_by_osym() index of the FST it wraps, with the transitions
+    mapped when they are looked up.
+    """
+
+    def __init__(self, view, index):
+        self.view = view
+        self.index = index
+
+    def get(self, sym, default=None):
+        arcs = self.index.get(sym)
+        if arcs is None:
+            return default
+        return self.view._map(arcs)
+
+    def __getitem__(self, sym):
+        return self.view._map(self.index[sym])
+
+    def __contains__(self, sym):
+        return sym in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+def inverted(origf, lazy=False):
+    """
+    Create an inverted FST from another FST. The inverse of
+    a ConstFST is a ConstFST that shares its arrays, and other
+    read-only FSTs, such as lazy compositions, are copied through
+    a MappedFST view. If lazy is True, return that view instead,
+    which takes constant time for any FST.
+    """
+    if lazy:
+        return MappedFST(origf, 'invert')
+    if isinstance(origf, ConstFST):
+        return ConstFST(origf.symbols, origf.offsets, origf.nextstates,
+                        origf.olabels, origf.ilabels, origf.weights,
+                        origf.initial, origf.final, origf.state_names)
+    if isinstance(origf, _ReadOnlyFST):
+        return MappedFST(origf, 'invert').materialize()
+
+    newf = FST()
+    newf.initial = origf.initial
+    newf.final = origf.final.copy()
+    for t in origf.transitions:
+        newf.add_transition(t[0], t[1], t[3], t[2], origf.transitions[t])
+
+    return newf
+
+def projected(f, side='input', lazy=False):
+    """
+    Project an FST on its input side (side='input'), making both
+    symbols of each transition its input symbol, or on its output
+    side (side='output'). If lazy is True, return a MappedFST view
+    instead of a copy.
+    """
+    if side not in ('input', 'output'):
+        raise ValueError("side must be 'input' or 'output', not %r" % (side,))
+    view = MappedFST(f, side)
+    if lazy:
+        return view
+    return view.materialize()
+
+def reweighted(f, scale=1, shift=0, lazy=False):
+    """
+    Map each weight w of an FST to w * scale + shift, for example
+    to apply an LM scale factor or a word insertion penalty. If
+    lazy is True, return a MappedFST view instead of a copy.
+    Searches won't work if the new weights are negative.
+    """
+    view = MappedFST(f, scale=scale, shift=shift)
+    if lazy:
+        return view
+    return view.materialize()
+
+def _matching_arcs(fst, state, index, sym):
+    """
+    Return the (transition, weight) pairs with input symbol sym
+    that can be taken from state, whose arcs_by_isym() is index.
+    If there are none, failure (PHI) transitions are followed until
+    a state that has some, and their weights are added to those of
+    the transitions returned. EPS counts as a symbol here, so
+    epsilon transitions are also reached through failure
+    transitions from a state that has none.
+    """
+    arcs = index.get(sym)
+    if arcs is not None:
+        return arcs
+    if PHI not in index:
+        return ()
+    result = []
+    stack = [(t[1], w) for t, w in index[PHI]]
+    seen = set([state])
+    seen.update(q for q, d in stack)
+    while len(stack) > 0:
+        q, d = stack.pop()
+        index = fst.arcs_by_isym(q)
+        if sym in index:
+            result.extend((t, d + w) for t, w in index[sym])
+        else:
+            for t, w in index.get(PHI, ()):
+                if t[1] not in seen:
+                    seen.add(t[1])
+                    stack.append((t[1], d + w))
+    return result
+
+def _compose_arcs(f, g, q1, q2, fs=None):
+    """
+    Return the transitions of the composition of f and g that
+    leave the pair of states (q1, q2), as (transition, weight)
+    pairs. Output symbols of f are matched against input symbols
+    of g through the per-state label indexes, iterating over the
+    side with fewer distinct symbols. If several pairs of
+    transitions give the same composed transition, the lowest
+    weight is kept.
+
+    If fs is None, epsilon moves in f and in g are taken
+    independently, so the same epsilon path may be built in
+    several interleavings. Otherwise fs is the state of a sequence
+    filter, product states are triples (q1, q2, fs), and between
+    two matched symbols all the epsilon moves in f come before the
+    epsilon moves in g: an epsilon move in f is only allowed in
+    filter state 0, an epsilon move in g goes to filter state 1,
+    and matching EPS against EPS is left to those two moves.
+
+    Failure (PHI) transitions in g are not matched themselves: a
+    symbol (or EPS) that g cannot read from q2 is read after
+    following them, and the result has a single transition with the
+    weights of the failure transitions added.
+    """
+    out1 = f.arcs_by_osym(q1)
+    in2 = g.arcs_by_isym(q2)
+    arcs = {}
+
+    def add(t, w):
+        if t not in arcs or w < arcs[t]:
+            arcs[t] = w
+
+    if fs is None:
+        src = (q1, q2)
+        def dst(r1, r2, fs2):
+            return (r1, r2)
+    else:
+        src = (q1, q2, fs)
+        def dst(r1, r2, fs2):
+            return (r1, r2, fs2)
+
+    # Epsilon moves in g, while f stays in q1.
+    for t2, w2 in _matching_arcs(g, q2, in2, EPS):
+        add((src, dst(q1, t2[1], 1), EPS, t2[3]), w2)
+
+    # Epsilon moves in f, while g stays in q2.
+    if fs != 1:
+        for t1, w1 in out1.get(EPS, ()):
+            add((src, dst(t1[1], q2, 0), t1[2], EPS), w1)
+
+    if len(out1) <= len(in2):
+        syms = [sym for sym in out1 if sym in in2]
+    else:
+        syms = [sym for sym in in2 if sym in out1]
+    if PHI in in2:
+        syms = [sym for sym in out1 if sym != PHI]
+    for sym in syms:
+        if sym == EPS and fs is not None:
+            continue
+        for t1, w1 in out1[sym]:
+            for t2, w2 in _matching_arcs(g, q2, in2, sym):
+                add((src, dst(t1[1], t2[1], 0), t1[2], t2[3]), w1 + w2)
+
+    if _stats is not None:
+        _stats['compose.states'] += 1
+        _stats['compose.arcs'] += len(arcs)
+    return list(arcs.items())
+
+class LazyComposeFST(_ReadOnlyFST):
+    """
+    The composition of two FSTs, f and g, computed on demand.
+    Product states are pairs (q1, q2), and the transitions leaving
+    a product state are only built (and then kept) the first time
+    arcs() is called for it, so a search such as short_paths() only
+    pays for the part of the composition it explores. The states
+    attribute lists the product states expanded so far. With the
+    default epsilon filter, product states are triples (q1, q2, fs);
+    see compose().
+    """
+
+    def __init__(self, f, g, filter='sequence'):
+        if filter not in ('sequence', None):
+            raise ValueError('unknown composition filter: %r' % (filter,))
+        self.f = f
+        self.g = g
+        self.filter = filter
+        if filter is None:
+            self.initial = (f.initial, g.initial)
+        else:
+            self.initial = (f.initial, g.initial, 0)
+        self.final = _ProductFinal(f.final, g.final, filter is not None)
+        self._expanded = {}
+        self._reset_caches()
+
+    @property
+    def states(self):
+        return self._expanded.keys()
+
+    def arcs(self, state):
+        arcs = self._expanded.get(state)
+        if arcs is None:
+            arcs = _compose_arcs(self.f, self.g, state[0], state[1], *state[2:])
+            self._expanded[state] = arcs
+        return arcs
+
+    def distance_to_final(self):
+        """
+        Return a lower bound on the distance from each product state
+        to a final state: the sum of the distances of its component
+        states in f and g, which are cached on the operands.
+        """
+        return _ProductDistance(self.f.distance_to_final(),
+                                self.g.distance_to_final())
+
+class _ProductFinal(object):
+    """
+    The final states of a composition, as a read-only set of
+    pairs of final states of its operands, or of triples with
+    either filter state if filtered is True.
+    """
+
+    def __init__(self, final1, final2, filtered=False):
+        self.final1 = final1
+        self.final2 = final2
+        self.filtered = filtered
+
+    def __contains__(self, state):
+        return state[0] in self.final1 and state[1] in self.final2
+
+    def __iter__(self):
+        for ff in self.final1:
+            for gf in self.final2:
+                if self.filtered:
+                    yield (ff, gf, 0)
+                    yield (ff, gf, 1)
+                else:
+                    yield (ff, gf)
+
+    def __len__(self):
+        n = len(self.final1) * len(self.final2)
+        if self.filtered:
+            n *= 2
+        return n
+
+class _ProductDistance(object):
+    """
+    Distances to a final state for the product states of a
+    composition, from the distances in its operands. A product
+    path projects onto a path in each operand, so with non-negative
+    weights the sum is a lower bound.
+    """
+
+    def __init__(self, dist1, dist2):
+        self.dist1 = dist1
+        self.dist2 = dist2
+
+    def get(self, state, default=None):
+        d1 = self.dist1.get(state[0])
+        d2 = self.dist2.get(state[1])
+        if d1 is None or d2 is None:
+            return default
+        return d1 + d2
+
+    def __contains__(self, state):
+        return self.get(state) is not None
+
+    def __getitem__(self, state):
+        d = self.get(state)
+        if d is None:
+            raise KeyError(state)
+        return d
+
+def compose(f, g, lazy=False, filter='sequence', state_table=False):
+    """
+    Compose two FSTs, f and g. If lazy is True, return a
+    LazyComposeFST that builds the composition on demand instead
+    of building all of it (and then trimming it) up front.
+
+    With filter='sequence', a path that interleaves epsilon moves
+    in f and g is only built in one order (epsilon moves in f
+    first), which avoids redundant paths through the composition,
+    and product states are triples (q1, q2, fs), where fs is the
+    state of the filter. With filter=None, epsilon moves are
+    taken independently and product states are pairs (q1, q2).
+
+    The states of the result are integers, numbered in the order
+    the product states are found, starting with 0 for the initial
+    state, so that states stay small in a cascade of compositions.
+    If state_table is True, the state_table attribute of the result
+    is the list of its product states, indexed by state; otherwise
+    it is None. The states of a LazyComposeFST are product states.
+    """
+    if filter not in ('sequence', None):
+        raise ValueError('unknown composition filter: %r' % (filter,))
+    if lazy:
+        return LazyComposeFST(f, g, filter)
+
+    if _stats is not None:
+        start = time.perf_counter()
+    c = FST()
+    if filter is None:
+        initial = (f.initial, g.initial)
+    else:
+        initial = (f.initial, g.initial, 0)
+    c.states.add(0)
+    c.initial = 0
+    # The id of each product state found so far, and the product
+    # state of each id.
+    ids = {initial: 0}
+    table = [initial]
+    a = deque([initial])
+
+    while len(a) > 0:
+        q = a.popleft()
+        src = ids[q]
+        for t, w in _compose_arcs(f, g, *q):
+            dst = ids.get(t[1])
+            if dst is None:
+                dst = ids[t[1]] = len(table)
+                table.append(t[1])
+                a.append(t[1])
+            c.add_transition(src, dst, t[2], t[3], w)
+
+    for q in _ProductFinal(f.final, g.final, filter is not None):
+        if q in ids:
+            c.set_final(ids[q])
+
+    c.cleanup()
+    c.state_table = table if state_table else None
+
+    if _stats is not None:
+        _stats['compose.calls'] += 1
+        _stats['compose.time'] += time.perf_counter() - start
+    return c
+
+class Semiring(object):
+    """
+    The operations used to combine weights. A semiring has a plus
+    operation, to combine the weights of alternative paths, and a
+    times operation, to combine the weights along a path, with the
+    identities zero and one. Weights are -log probabilities (or
+    costs) in both semirings here, so times is addition, one is 0
+    and zero is infinity.
+
+    Other semirings can be used with shortest_distance() by
+    subclassing Semiring and defining plus() (and times(), zero and
+    one if weights are not costs). They are computed in Python;
+    only the semirings that name a NumPy ufunc for plus in _ufunc
+    are computed over the arrays of a ConstFST.
+    """
+
+    name = None
+    zero = math.inf
+    one = 0.0
+    # The name of the NumPy ufunc for plus, if there is one, and
+    # the sign of the weights it works on.
+    _ufunc = None
+    _sign = 1
+
+    def plus(self, a, b):
+        raise NotImplementedError('%s does not define plus()' % type(self).__name__)
+
+    def times(self, a, b):
+        return a + b
+
+    def __repr__(self):
+        return '%s()' % type(self).__name__
+
+class TropicalSemiring(Semiring):
+    """
+    The tropical semiring, where plus is min: the weight of a set
+    of paths is the weight of the best one. This is the semiring
+    of short_paths() and viterbi().
+    """
+
+    name = 'tropical'
+    _ufunc = 'minimum'
+
+    def plus(self, a, b):
+        return a if a < b else b
+
+class LogSemiring(Semiring):
+    """
+    The log semiring, where plus is -log(exp(-a) + exp(-b)): the
+    weight of a set of paths is -log of the sum of their
+    probabilities. It is computed as min(a, b) - log1p(exp(-|a - b|)),
+    which does not underflow for large weights.
+    """
+
+    name = 'log'
+    _ufunc = 'logaddexp'
+    _sign = -1
+
+    def plus(self, a, b):
+        if a == math.inf:
+            return b
+        if b == math.inf:
+            return a
+        if a < b:
+            return a - math.log1p(math.exp(a - b))
+        return b - math.log1p(math.exp(b - a))
+
+TROPICAL = TropicalSemiring()
+LOG = LogSemiring()
+SEMIRINGS = {'tropical': TROPICAL, 'log': LOG}
+
+def _semiring(semiring):
+    """
+    Return the Semiring for a Semiring or the name of one.
+    """
+    if isinstance(semiring, Semiring):
+        return semiring
+    if semiring not in SEMIRINGS:
+        raise ValueError('unknown semiring: %r' % (semiring,))
+    return SEMIRINGS[semiring]
+
+def shortest_distance(fst, semiring='tropical', reverse=False):
+    """
+    Return a dict with the shortest distance from the initial state
+    to each state reachable from it, in the given semiring
+    ('tropical', 'log', or a Semiring). If reverse is True, return
+    the distance from each state to the final states instead, for
+    (at least) the states reachable from the initial state, leaving
+    out those that cannot reach a final state. In the log semiring
+    the distance is -log of the total probability of the paths, so
+    shortest_distance(fst, 'log', reverse=True)[fst.initial] is
+    the total weight of the FST.
+
+    If the reachable part of the FST is acyclic, as it is for the
+    composition of a linear chain with an epsilon-cycle-free FST,
+    the states are relaxed once, in topological order, which also
+    works with negative weights. For a ConstFST this is done with
+    NumPy, one layer of states at a time, if NumPy is available.
+    Otherwise Dijkstra's algorithm is used in the tropical
+    semiring, which won't work with negative weights, and the
+    generic shortest-distance algorithm in the log semiring.
+    """
+    semiring = _semiring(semiring)
+    if isinstance(semiring, TropicalSemiring) and not reverse:
+        dist, back = _viterbi(fst)
+        return dist
+    if fst.initial is None:
+        return {}
+    if (np is not None and semiring._ufunc is not None and isinstance(fst, ConstFST)
+            and fst.num_arcs() > 0):
+        dist = _shortest_distance_arrays(fst, semiring, reverse)
+        if dist is not None:
+            reached = np.flatnonzero(np.isfinite(dist))
+            return dict(zip(reached.tolist(), dist[reached].tolist()))
+    return _shortest_distance(fst, semiring, reverse)
+
+def viterbi(fst):
+    """
+    Return the shortest path from the initial state to a final
+    state, as a Path (weight, input symbols, output symbols) with
+    EPS removed from the symbol lists, or None if there is no such
+    path. See shortest_distance() for how it is computed.
+    """
+    dist, back = _viterbi(fst)
+    best = None
+    for s in fst.final:
+        if s in dist and (best is None or dist[s] < dist[best]):
+            best = s
+    if best is None:
+        return None
+
+    istr = []
+    ostr = []
+    q = best
+    while q in back:
+        t = back[q]
+        if t[2] != EPS:
+            istr.append(t[2])
+        if t[3] != EPS:
+            ostr.append(t[3])
+        q = t[0]
+    istr.reverse()
+    ostr.reverse()
+    return Path(dist[best], istr, ostr)
+
+def _viterbi(fst):
+    """
+    Compute the shortest distances from the initial state of fst,
+    and for each state the last transition of a shortest path to
+    it, as two dicts.
+    """
+    if fst.initial is None:
+        return {}, {}
+    if np is not None and isinstance(fst, ConstFST) and fst.num_arcs() > 0:
+        result = _viterbi_arrays(fst)
+        if result is not None:
+            return result
+
+    order = _topological_order(fst)
+    if order is None:
+        return _dijkstra(fst)
+    dist = {fst.initial: 0}
+    back = {}
+    for q in order:
+        d = dist[q]
+        for t, w in fst.arcs(q):
+            if t[1] not in dist or d + w < dist[t[1]]:
+                dist[t[1]] = d + w
+                back[t[1]] = t
+    return dist, back
+
+def _topological_order(fst):
+    """
+    Return the states reachable from the initial state of fst in
+    topological order, or None if there is a cycle among them.
+    """
+    order = []
+    # A state is 1 while on the depth-first search stack, 2 after.
+    color = {fst.initial: 1}
+    stack = [(fst.initial, iter(fst.arcs(fst.initial)))]
+    while len(stack) > 0:
+        q, it = stack[-1]
+        for t, w in it:
+            c = color.get(t[1])
+            if c is None:
+                color[t[1]] = 1
+                stack.append((t[1], iter(fst.arcs(t[1]))))
+                break
+            if c == 1:
+                return None
+        else:
+            stack.pop()
+            color[q] = 2
+            order.append(q)
+    order.reverse()
+    return order
+
+def _dijkstra(fst):
+    """
+    Compute the shortest distances from the initial state of fst,
+    and the last transition of each shortest path, with Dijkstra's
+    algorithm.
+    """
+    dist = {}
+    back = {}
+    h = [(0, 0, fst.initial, None)]
+    cnt = 1
+    while len(h) > 0:
+        d, _, q, t = heapq.heappop(h)
+        if q in dist:
+            continue
+        dist[q] = d
+        if t is not None:
+            back[q] = t
+        for t, w in fst.arcs(q):
+            if t[1] not in dist:
+                heapq.heappush(h, (d + w, cnt, t[1], t))
+                cnt += 1
+    return dist, back
+
+def _viterbi_arrays(fst):
+    """
+    Same as _viterbi() for an acyclic ConstFST, with NumPy. States
+    are processed in layers: a layer is the set of states whose
+    incoming transitions all leave earlier layers, and the
+    transitions leaving a layer are relaxed together. Returns None
+    if some states are never reached by this process, because of
+    a cycle.
+    """
+    nstates = fst.num_states()
+    offsets = np.frombuffer(fst.offsets, dtype=np.int64)
+    dst = np.frombuffer(fst.nextstates, dtype=np.int32)
+    weights = np.frombuffer(fst.weights, dtype=np.float64)
+    counts = np.diff(offsets)
+    src = np.repeat(np.arange(nstates), counts)
+
+    indegree = np.bincount(dst, minlength=nstates)
+    dist = np.full(nstates, np.inf)
+    dist[fst.initial] = 0
+    back = np.full(nstates, -1, dtype=np.int64)
+
+    layer = np.flatnonzero(indegree == 0)
+    done = 0
+    while len(layer) > 0:
+        done += len(layer)
+        # Indexes of the transitions leaving the states in layer.
+        n = counts[layer]
+        ends = np.cumsum(n)
+        arcs = np.arange(ends[-1]) + np.repeat(offsets[layer] - ends + n, n)
+        if len(arcs) == 0:
+            break
+        targets = dst[arcs]
+        d = dist[src[arcs]] + weights[arcs]
+        np.minimum.at(dist, targets, d)
+        win = (d == dist[targets]) & np.isfinite(d)
+        back[targets[win]] = arcs[win]
+        indegree -= np.bincount(targets, minlength=nstates)
+        targets = np.unique(targets)
+        layer = targets[indegree[targets] == 0]
+    if done < nstates:
+        return None
+
+    reached = np.flatnonzero(np.isfinite(dist))
+    dist_dict = dict(zip(reached.tolist(), dist[reached].tolist()))
+    return dist_dict, _ArrayBackPointers(fst, src, back)
+
+class _ArrayBackPointers(object):
+    """
+    The last transition of a shortest path to each state, from an
+    array of transition indexes of a ConstFST (-1 for none), built
+    as a transition tuple only when it is looked up.
+    """
+
+    def __init__(self, fst, src, back):
+        self.fst = fst
+        self.src = src
+        self.back = back
+
+    def __contains__(self, q):
+        return self.back[q] >= 0
+
+    def __getitem__(self, q):
+        k = int(self.back[q])
+        if k < 0:
+            raise KeyError(q)
+        syms = self.fst.symbols
+        return (int(self.src[k]), q, syms[self.fst.ilabels[k]],
+                syms[self.fst.olabels[k]])
+
+def _shortest_distance(fst, semiring, reverse):
+    """
+    Same as shortest_distance() without NumPy.
+    """
+    plus = semiring.plus
+    times = semiring.times
+    order = _topological_order(fst)
+    if order is not None:
+        if not reverse:
+            dist = {fst.initial: semiring.one}
+            for q in order:
+                d = dist[q]
+                for t, w in fst.arcs(q):
+                    if t[1] in dist:
+                        dist[t[1]] = plus(dist[t[1]], times(d, w))
+                    else:
+                        dist[t[1]] = times(d, w)
+            return dist
+        dist = {}
+        for q in reversed(order):
+            d = semiring.one if q in fst.final else semiring.zero
+            for t, w in fst.arcs(q):
+                if t[1] in dist:
+                    d = plus(d, times(w, dist[t[1]]))
+            if d != semiring.zero:
+                dist[q] = d
+        return dist
+
+    if not reverse:
+        if isinstance(semiring, TropicalSemiring):
+            dist, back = _dijkstra(fst)
+            return dist
+        return _generic_distance([fst.initial], lambda q: [(t[1], w) for t, w in fst.arcs(q)],
+                                 semiring)
+
+    # The transitions between the reachable states, followed
+    # backwards from the final states.
+    reverse_arcs = defaultdict(list)
+    visited = set([fst.initial])
+    a = deque([fst.initial])
+    while len(a) > 0:
+        q = a.popleft()
+        for t, w in fst.arcs(q):
+            reverse_arcs[t[1]].append((q, w))
+            if t[1] not in visited:
+                visited.add(t[1])
+                a.append(t[1])
+    finals = [s for s in fst.final if s in visited]
+    return _generic_distance(finals, lambda q: reverse_arcs.get(q, ()), semiring)
+
+def _generic_distance(sources, arcs, semiring, delta=1e-9):
+    """
+    Mohri's generic single-source shortest-distance algorithm, for
+    FSTs with cycles: return a dict with the distance from the
+    source states to each state reachable from them, where arcs(q)
+    returns the (next state, weight) pairs of state q. Each state
+    keeps the weight added to its distance since it was last
+    visited, and is queued again until that weight changes its
+    distance by less than delta.
+    """
+    plus = semiring.plus
+    times = semiring.times
+    dist = {}
+    residual = {}
+    for s in sources:
+        dist[s] = semiring.one
+        residual[s] = semiring.one
+    a = deque(dist)
+    queued = set(a)
+    while len(a) > 0:
+        q = a.popleft()
+        queued.remove(q)
+        r = residual.pop(q)
+        for s, w in arcs(q):
+            x = times(r, w)
+            d = dist.get(s)
+            newd = x if d is None else plus(d, x)
+            if d is None or abs(d - newd) > delta:
+                dist[s] = newd
+                residual[s] = plus(residual[s], x) if s in residual else x
+                if s not in queued:
+                    queued.add(s)
+                    a.append(s)
+    return dist
+
+def _shortest_distance_arrays(fst, semiring, reverse):
+    """
+    Same as shortest_distance() for an acyclic ConstFST, with NumPy,
+    in layers of states as in _viterbi_arrays(). If reverse is True,
+    the transitions are followed backwards, from the final states.
+    Returns an array of distances, infinite for the states that are
+    not reached, or None if there is a cycle or the semiring has no
+    NumPy ufunc.
+    """
+    if semiring._ufunc is None:
+        return None
+    nstates = fst.num_states()
+    offsets = np.frombuffer(fst.offsets, dtype=np.int64)
+    dst = np.frombuffer(fst.nextstates, dtype=np.int32)
+    weights = np.frombuffer(fst.weights, dtype=np.float64)
+    counts = np.diff(offsets)
+    src = np.repeat(np.arange(nstates), counts)
+    starts = [fst.initial]
+    if reverse:
+        order = np.argsort(dst, kind='stable')
+        src, dst, weights = dst[order], src[order], weights[order]
+        counts = np.bincount(src, minlength=nstates)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        starts = sorted(fst.final)
+
+    # Plus is applied with a NumPy ufunc, on the weights multiplied
+    # by the sign of the semiring: -log probabilities are added up
+    # as log probabilities with logaddexp.
+    plus = getattr(np, semiring._ufunc)
+    sign = semiring._sign
+    indegree = np.bincount(dst, minlength=nstates)
+    dist = np.full(nstates, sign * np.inf)
+    dist[starts] = 0
+
+    layer = np.flatnonzero(indegree == 0)
+    done = 0
+    while len(layer) > 0:
+        done += len(layer)
+        n = counts[layer]
+        ends = np.cumsum(n)
+        arcs = np.arange(ends[-1]) + np.repeat(offsets[layer] - ends + n, n)
+        if len(arcs) == 0:
+            break
+        targets = dst[arcs]
+        plus.at(dist, targets, dist[src[arcs]] + sign * weights[arcs])
+        indegree -= np.bincount(targets, minlength=nstates)
+        targets = np.unique(targets)
+        layer = targets[indegree[targets] == 0]
+    if done < nstates:
+        return None
+    return sign * dist
+
+def posteriors(fst):
+    """
+    Return a dict that maps each transition on a path from the
+    initial state to a final state to its posterior weight: -log
+    of the probability that a path goes through it, where the
+    weights of the FST are -log probabilities. This is
+    alpha(state1) + weight + beta(state2) - total, with the
+    forward (alpha) and backward (beta) distances and the total
+    weight in the log semiring.
+    """
+    result = {}
+    if fst.initial is None:
+        return result
+    alpha = shortest_distance(fst, LOG)
+    beta = shortest_distance(fst, LOG, reverse=True)
+    total = beta.get(fst.initial)
+    if total is None:
+        return result
+    for q, a in alpha.items():
+        for t, w in fst.arcs(q):
+            b = beta.get(t[1])
+            if b is not None:
+                result[t] = a + w + b - total
+    return result
+
+def prune(fst, threshold, semiring='tropical'):
+    """
+    Return a copy of fst without the transitions whose best path
+    from the initial state to a final state costs more than the
+    best path of the FST plus threshold, and without the final
+    states whose best path does. In the 'log' semiring, the
+    transitions are pruned by their posterior weight (see
+    posteriors()) instead, so that threshold is -log of the
+    smallest posterior probability kept. Pruning the lattice
+    built by compose() makes the searches of short_paths() on it
+    faster.
+
+    Other Semirings can be given as well, as long as their weights
+    are costs, which are compared by their difference.
+
+    The result is an FST with the same state names, or a ConstFST
+    for a ConstFST. With NumPy, a ConstFST is pruned over its
+    arrays, and keeps its state numbers.
+    """
+    semiring = _semiring(semiring)
+    if (np is not None and semiring._ufunc is not None and isinstance(fst, ConstFST)
+            and fst.initial is not None):
+        pruned = _prune_arrays(fst, threshold, semiring)
+        if not isinstance(semiring, TropicalSemiring):
+            # Transitions that lead only to pruned ones are left.
+            pruned = _prune_arrays(pruned, np.inf, TROPICAL)
+        return pruned
+
+    result = FST()
+    if fst.initial is not None:
+        alpha = shortest_distance(fst, semiring)
+        beta = shortest_distance(fst, semiring, reverse=True)
+        total = beta.get(fst.initial)
+        if total is not None:
+            result.set_initial(fst.initial)
+            for q, a in alpha.items():
+                for t, w in fst.arcs(q):
+                    b = beta.get(t[1])
+                    if b is not None and a + w + b - total <= threshold:
+                        result.add_transition(t[0], t[1], t[2], t[3], w)
+                if q in fst.final and a - total <= threshold:
+                    result.set_final(q)
+            if not isinstance(semiring, TropicalSemiring):
+                result.cleanup()
+    if isinstance(fst, ConstFST):
+        result = result.freeze()
+        if fst.state_names is not None:
+            result.state_names = [fst.state_names[q] for q in result.state_names]
+    return result
+
+def _prune_arrays(fst, threshold, semiring):
+    """
+    Same as prune() for a ConstFST, with NumPy.
+    """
+    nstates = fst.num_states()
+    alpha = _distance_array(fst, semiring, False)
+    beta = _distance_array(fst, semiring, True)
+    total = beta[fst.initial]
+    offsets = np.frombuffer(fst.offsets, dtype=np.int64)
+    dst = np.frombuffer(fst.nextstates, dtype=np.int32)
+    weights = np.frombuffer(fst.weights, dtype=np.float64)
+    src = np.repeat(np.arange(nstates), np.diff(offsets))
+
+    if np.isfinite(total):
+        cost = alpha[src] + weights + beta[dst] - total
+        keep = np.isfinite(cost) & (cost <= threshold)
+        final = [s for s in fst.final if alpha[s] - total <= threshold]
+    else:
+        keep = np.zeros(len(dst), dtype=bool)
+        final = []
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(src[keep], minlength=nstates))))
+
+    def kept(labels, typecode, dtype):
+        return array(typecode, np.frombuffer(labels, dtype=dtype)[keep].tobytes())
+
+    return ConstFST(fst.symbols, array('q', offsets.astype(np.int64).tobytes()),
+                    kept(fst.nextstates, 'i', np.int32), kept(fst.ilabels, 'i', np.int32),
+                    kept(fst.olabels, 'i', np.int32), kept(fst.weights, 'd', np.float64),
+                    fst.initial, final, fst.state_names)
+
+def _distance_array(fst, semiring, reverse):
+    """
+    Return the distances of shortest_distance() for a ConstFST as
+    an array, with NumPy, infinite for the states left out.
+    """
+    dist = None
+    if fst.num_arcs() > 0:
+        dist = _shortest_distance_arrays(fst, semiring, reverse)
+    if dist is None:
+        dist = np.full(fst.num_states(), np.inf)
+        if isinstance(semiring, TropicalSemiring) and not reverse:
+            d, back = _viterbi(fst)
+        else:
+            d = _shortest_distance(fst, semiring, reverse)
+        if len(d) > 0:
+            dist[list(d)] = list(d.values())
+    return dist
+
+def rmepsilon(fst):
+    """
+    Return a new FST, equivalent to fst, without EPS:EPS
+    transitions. For each state q reachable from the initial
+    state, the shortest distance from q to each state in its
+    epsilon closure is computed with Dijkstra's algorithm, and the
+    transitions with a non-EPS symbol that leave the closure are
+    copied to q with that distance added to their weight (keeping
+    the lowest weight if several are copied to the same one).
+    Since there are no final weights, a state that reaches a final
+    state only through epsilon transitions with a non-zero weight
+    gets a single EPS:EPS transition with that weight into an extra
+    final state, which has no transitions leaving it.
+    Won't work with negative weights.
+    """
+    result = FST()
+    if fst.initial is None:
+        return result
+    result.set_initial(fst.initial)
+    superfinal = '<final>'
+    while superfinal in fst.states:
+        superfinal += "'"
+
+    a = deque([fst.initial])
+    visited = set(a)
+    while len(a) > 0:
+        q = a.popleft()
+        closure = _epsilon_closure(fst, q)
+
+        arcs = {}
+        final_weight = None
+        for q2, d in closure.items():
+            if q2 in fst.final and (final_weight is None or d < final_weight):
+                final_weight = d
+            for t, w in fst.arcs(q2):
+                if t[2] == EPS and t[3] == EPS:
+                    continue
+                key = (q, t[1], t[2], t[3])
+                if key not in arcs or d + w < arcs[key]:
+                    arcs[key] = d + w
+
+        for t, w in arcs.items():
+            result.add_transition(t[0], t[1], t[2], t[3], w)
+            if t[1] not in visited:
+                visited.add(t[1])
+                a.append(t[1])
+        if final_weight == 0:
+            result.set_final(q)
+        elif final_weight is not None:
+            result.add_transition(q, superfinal, EPS, EPS, final_weight)
+            result.set_final(superfinal)
+
+    result.cleanup()
+    return result
+
+def _epsilon_closure(fst, state):
+    """
+    Return a dict with the shortest distance from state to each
+    state reachable from it through EPS:EPS transitions (including
+    state itself, at distance 0).
+    """
+    dist = {}
+    heap = [(0, 0, state)]
+    cnt = 1
+    while len(heap) > 0:
+        d, _, q = heapq.heappop(heap)
+        if q in dist:
+            continue
+        dist[q] = d
+        for t, w in fst.arcs_by_isym(q).get(EPS, ()):
+            if t[3] == EPS and t[1] not in dist:
+                heapq.heappush(heap, (d + w, cnt, t[1]))
+                cnt += 1
+    return dist
+
+def determinize(fst, encode=False, delta=1e-6):
+    """
+    Determinize a weighted FST in the tropical semiring, returning
+    a new FST with integer states in which no state has two
+    transitions with the same input symbol. Each state of the
+    result is a set of (state, residual output, residual weight)
+    triples of fst, and output symbols are emitted as soon as all
+    the paths read so far agree on them. Residual weights are
+    compared up to delta.
+
+    fst must not have transitions with EPS as input symbol, and it
+    must be functional (each input string has one output string),
+    or a ValueError is raised. With encode=True, each (input,
+    output) symbol pair is treated as a single symbol instead, so
+    the result is deterministic on pairs; this works for any FST
+    without EPS:EPS transitions. Since there are no final weights,
+    final residuals are placed on EPS input transitions into an
+    extra final state. Determinization may not terminate for FSTs
+    that are not determinizable (whose ambiguous paths have cycles
+    with different weights).
+    """
+    result = FST()
+    if fst.initial is None:
+        return result
+
+    subsets = {}
+    elements = []
+    superfinal = []
+
+    def new_state():
+        elements.append(None)
+        return len(elements) - 1
+
+    def subset_state(items):
+        key = frozenset((q, out, round(v / delta)) for (q, out), v in items.items())
+        s = subsets.get(key)
+        if s is None:
+            s = new_state()
+            subsets[key] = s
+            elements[s] = list(items.items())
+            a.append(s)
+        return s
+
+    def add_path(s1, s2, isym, olabels, weight):
+        # A transition that outputs several symbols is split into
+        # a chain of transitions with EPS input.
+        olabels = list(olabels) or [EPS]
+        for i, osym in enumerate(olabels):
+            nxt = s2 if i == len(olabels) - 1 else new_state()
+            result.add_transition(s1, nxt, isym, osym, weight)
+            s1 = nxt
+            isym = EPS
+            weight = 0
+
+    a = deque()
+    result.set_initial(subset_state({(fst.initial, ()): 0}))
+
+    while len(a) > 0:
+        s = a.popleft()
+
+        finals = [(v, out) for (q, out), v in elements[s] if q in fst.final]
+        if len(finals) > 0:
+            v, out = min(finals)
+            if not encode and any(out2 != out for v2, out2 in finals):
+                raise ValueError('cannot determinize an FST that is not functional; '
+                                 'use encode=True')
+            if v == 0 and len(out) == 0:
+                result.set_final(s)
+            else:
+                if len(superfinal) == 0:
+                    superfinal.append(new_state())
+                    result.set_final(superfinal[0])
+                add_path(s, superfinal[0], EPS, out, v)
+
+        groups = {}
+        for (q, out), v in elements[s]:
+            for t, w in fst.arcs(q):
+                if encode:
+                    if t[2] == EPS and t[3] == EPS:
+                        raise ValueError('cannot determinize an FST with EPS:EPS transitions')
+                    label = (t[2], t[3])
+                    nout = ()
+                else:
+                    if t[2] == EPS:
+                        raise ValueError('cannot determinize an FST with EPS input symbols')
+                    label = t[2]
+                    nout = out + ((t[3],) if t[3] != EPS else ())
+                groups.setdefault(label, []).append((t[1], nout, v + w))
+
+        for label, items in groups.items():
+            w0 = min(v for q, out, v in items)
+            if encode:
+                isym, osym = label
+                prefix = (osym,)
+            else:
+                isym = label
+                prefix = _common_prefix([out for q, out, v in items])
+            residuals = {}
+            for q, out, v in items:
+                key = (q, out[len(prefix):])
+                if key not in residuals or v - w0 < residuals[key]:
+                    residuals[key] = v - w0
+            add_path(s, subset_state(residuals), isym, prefix, w0)
+
+    return result
+
+def _common_prefix(strings):
+    """
+    Return the longest common prefix of a list of tuples.
+    """
+    prefix = strings[0]
+    for s in strings[1:]:
+        i = 0
+        while i < len(prefix) and i < len(s) and prefix[i] == s[i]:
+            i += 1
+        prefix = prefix[:i]
+    return prefix
+
+def minimize(fst, delta=1e-6):
+    """
+    Return a new FST with integer states, equivalent to fst, in
+    which equivalent states are merged. Weights are first pushed
+    towards the initial state, using distance_to_final(), so that
+    equivalent states have the same weights on their transitions.
+    Then states are split into blocks until all the states in a
+    block agree on finality and on the (input symbol, output
+    symbol, weight, block of the next state) of their transitions
+    (weights are compared up to delta), and each block becomes a
+    state. Only states on a path from the initial state to a final
+    state are kept. The result is minimal if fst is deterministic,
+    e.g. the result of determinize().
+    Won't work with negative weights.
+    """
+    result = FST()
+    if fst.initial is None:
+        return result
+    dist = _distance_to_final(fst)
+    if fst.initial not in dist:
+        return result
+
+    # The states on a path from the initial state to a final state,
+    # with their transitions and pushed weights.
+    arcs = {}
+    a = deque([fst.initial])
+    arcs[fst.initial] = None
+    while len(a) > 0:
+        q = a.popleft()
+        arcs[q] = []
+        for t, w in fst.arcs(q):
+            if t[1] in dist:
+                arcs[q].append((t[1], t[2], t[3], w + dist[t[1]] - dist[q]))
+                if t[1] not in arcs:
+                    arcs[t[1]] = None
+                    a.append(t[1])
+
+    block = dict((q, 1 if q in fst.final else 0) for q in arcs)
+    nblocks = len(set(block.values()))
+    while True:
+        signatures = {}
+        new_block = {}
+        for q in arcs:
+            sig = (block[q], frozenset((isym, osym, round(w / delta), block[q2])
+                                       for q2, isym, osym, w in arcs[q]))
+            new_block[q] = signatures.setdefault(sig, len(signatures))
+        block = new_block
+        if len(signatures) == nblocks:
+            break
+        nblocks = len(signatures)
+
+    done = set()
+    for q in arcs:
+        b = block[q]
+        if b in done:
+            continue
+        done.add(b)
+        if q in fst.final:
+            result.set_final(b)
+        for q2, isym, osym, w in arcs[q]:
+            t = (b, block[q2], isym, osym)
+            if t not in result.transitions:
+                result.add_transition(b, block[q2], isym, osym, w)
+
+    # The weight pushed out of the initial state goes on the
+    # transitions leaving it, in a new initial state if the old
+    # one can be entered again.
+    initial = block[fst.initial]
+    d0 = dist[fst.initial]
+    if d0 == 0:
+        result.set_initial(initial)
+    else:
+        if result.to_states[initial] > 0:
+            start = nblocks
+            if initial in result.final:
+                result.set_final(start)
+        else:
+            start = initial
+        for t in list(result.transitions_by_state[initial]):
+            w = result.transitions[t]
+            if start == initial:
+                result.rm_transition(t)
+            result.add_transition(start, t[1], t[2], t[3], w + d0)
+        result.set_initial(start)
+    return result
+
+def from_lexicon(pairs, sorted=True, closure=False):
+    """
+    Build a minimal acyclic FST that maps each input string to
+    its output strings, from pairs (input_symbols, output_symbols)
+    of lists of symbols, such as (phones, [word]) for each entry of
+    a pronunciation dictionary. Each pair is read as a string of
+    (input symbol, output symbol) labels: input symbols come first
+    and output symbols last, with EPS filling the rest of the
+    shorter side, so that entries share transitions for as long as
+    their inputs agree, and the output is only emitted at the end.
+
+    The FST is built incrementally, as a trie whose branches are
+    merged with equivalent states already built as soon as no later
+    entry can extend them, so only the minimal FST and the states
+    of the last entry are kept in memory. This needs the entries in
+    sorted order of their label strings; if sorted is False, they
+    are sorted first. A ValueError is raised for entries that are
+    out of order. If closure is True, the FST accepts sequences of
+    entries instead: its initial state is also its final state, and
+    entries end back in it.
+    """
+    entries = (_lexicon_labels(inp, out) for inp, out in pairs)
+    if not sorted:
+        entries = list(entries)
+        entries.sort()
+
+    # Each state is a pair [is_final, {label: next_state}]. The
+    # states along the last entry are in path, and are not in the
+    # register of unique states yet.
+    states = [[False, {}]]
+    register = {}
+    path = [0]
+    prev = ()
+
+    def merge(depth):
+        # Replace each state of the last entry below depth, deepest
+        # first, with an equivalent state in the register, or add it
+        # to the register if there is none.
+        while len(path) > depth + 1:
+            q = path.pop()
+            final, arcs = states[q]
+            key = (final, tuple(arcs.items()))
+            r = register.get(key)
+            if r is None:
+                register[key] = q
+            else:
+                states[path[-1]][1][prev[len(path) - 1]] = r
+                states[q] = None
+
+    first = True
+    for entry in entries:
+        if not first and entry <= prev:
+            if entry == prev:
+                continue
+            raise ValueError('lexicon entries are not sorted: %r after %r' % (entry, prev))
+        first = False
+        k = 0
+        while k < len(prev) and k < len(entry) and prev[k] == entry[k]:
+            k += 1
+        merge(k)
+        for label in entry[k:]:
+            states.append([False, {}])
+            states[path[-1]][1][label] = len(states) - 1
+            path.append(len(states) - 1)
+        states[path[-1]][0] = True
+        prev = entry
+    merge(0)
+
+    # Number the states from 0, the initial state, in breadth-first
+    # order. With closure, a final state without transitions is the
+    # initial state, and other final states get an EPS transition
+    # back to it.
+    result = FST()
+    result.set_initial(0)
+    ids = {0: 0}
+    nstates = 1
+    a = deque([0])
+    while len(a) > 0:
+        q = a.popleft()
+        final, arcs = states[q]
+        if final:
+            if not closure:
+                result.set_final(ids[q])
+            elif ids[q] != 0:
+                result.add_transition(ids[q], 0, EPS, EPS)
+        for (isym, osym), r in arcs.items():
+            if r not in ids:
+                if closure and states[r][0] and len(states[r][1]) == 0:
+                    ids[r] = 0
+                else:
+                    ids[r] = nstates
+                    nstates += 1
+                    a.append(r)
+            result.add_transition(ids[q], ids[r], isym, osym)
+    if closure:
+        result.set_final(0)
+    return result
+
+def _lexicon_labels(input_symbols, output_symbols):
+    """
+    Return the string of (input symbol, output symbol) labels for
+    a lexicon entry, with the input symbols first and the output
+    symbols last.
+    """
+    n = max(len(input_symbols), len(output_symbols))
+    isyms = list(input_symbols) + [EPS] * (n - len(input_symbols))
+    osyms = [EPS] * (n - len(output_symbols)) + list(output_symbols)
+    return tuple(zip(isyms, osyms))
+
+def linear_chain(syms):
+    """
+    Create a linear chain FST, encoding a string.
+    syms is a list containing the symbols of the string.
+    """
+    f = FST()
+    curr_state = 0
+    f.set_initial(curr_state)
+    for s in syms:
+        next_state = curr_state + 1
+        f.add_transition(curr_state, next_state, s, s, 0)
+        curr_state = next_state
+    f.set_final(curr_state)
+    return f
+
+def linear_chain_from_string(mystr, sep=''):
+    """
+    Create a linear chain FST, encoding a string.
+    mystr is a string, and sep is the separator. If no
+    separator is provided, the string is split into
+    characters.
+    """
+    if sep == '':
+        toks = list(mystr)
+    else:
+        toks = mystr.split(sep=sep)
+
+    return linear_chain(toks)
+
+class TransductionService(object):
+    """
+    An asyncio front end to decode() for many concurrent requests
+    on one FST. Requests wait in a queue of at most max_queue
+    requests, and are sent to a pool of worker processes in
+    micro-batches: a batch is sent as soon as it has max_batch
+    requests, or batch_wait seconds after its first request, and at
+    most two batches per worker are in flight, so that a busy
+    service fills its queue instead of piling work onto the pool.
+
+    Use it in a running event loop:
+
+        service = TransductionService(myfst, workers=4)
+        await service.start()
+        paths = await service.transduce('this is a test', n=3)
+        await service.close()
+
+    timeout is the default number of seconds a request may take,
+    and options are default keyword arguments for decode() (such
+    as beam or max_expansions), to bound the work per request.
+    With workers=1, requests are decoded in a thread of this
+    process instead. As with transduce_batch(), the workers share
+    the FST with this process where processes are started by
+    forking.
+    """
+
+    def __init__(self, fst, workers=None, max_batch=32, batch_wait=0.002,
+                 max_queue=1024, timeout=None, **options):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.fst = fst
+        self.workers = workers
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.options = options
+        self._queue = None
+        self._executor = None
+        self._batcher = None
+
+    async def start(self):
+        """
+        Start the worker pool and the batching task.
+        """
+        if self.workers == 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        else:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+            else:
+                context = multiprocessing.get_context()
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=context, initializer=_batch_init,
+                initargs=(self.fst,))
+        self._queue = asyncio.Queue(self.max_queue)
+        self._inflight = asyncio.Semaphore(2 * self.workers)
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+
+    async def close(self):
+        """
+        Stop the batching task and the worker pool. Requests that
+        are still queued fail with asyncio.CancelledError.
+        """
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            item[-1].cancel()
+        self._executor.shutdown(wait=True)
+
+    async def transduce(self, input_symbols, n=1, sep=' ', timeout=None, **options):
+        """
+        Return the PathList of decode() for input_symbols, a list of
+        symbols or a string split with sep (into characters if sep
+        is ''). The remaining keyword arguments are passed to
+        decode(), after the defaults of the service. If the queue is
+        full, asyncio.QueueFull is raised at once, and if the request
+        takes more than timeout seconds (by default, the timeout of
+        the service), TimeoutError is raised.
+        """
+        if isinstance(input_symbols, str):
+            if sep == '':
+                input_symbols = list(input_symbols)
+            else:
+                input_symbols = input_symbols.split(sep)
+        if timeout is None:
+            timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        deadline = None
+        if timeout is not None:
+            deadline = loop.time() + timeout
+        opts = dict(self.options)
+        opts.update(options)
+        future = loop.create_future()
+        self._queue.put_nowait((input_symbols, n, opts, deadline, future))
+        if timeout is None:
+            return await future
+        return await asyncio.wait_for(future, max(0, deadline - loop.time()))
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._inflight.acquire()
+            batch = [await self._queue.get()]
+            end = loop.time() + self.batch_wait
+            while len(batch) < self.max_batch:
+                timeout = end - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Requests that are past their deadline, or whose caller
+            # gave up, are not decoded.
+            now = loop.time()
+            live = []
+            for item in batch:
+                deadline, future = item[3], item[4]
+                if future.done():
+                    continue
+                if deadline is not None and now >= deadline:
+                    future.set_exception(TimeoutError())
+                    continue
+                live.append(item)
+            if len(live) == 0:
+                self._inflight.release()
+                continue
+
+            requests = [(symbols, n, opts) for symbols, n, opts, deadline, future in live]
+            if self.workers == 1:
+                job = loop.run_in_executor(self._executor, _serve_decode, requests, self.fst)
+            else:
+                job = loop.run_in_executor(self._executor, _serve_decode, requests)
+            job.add_done_callback(lambda job, live=live: self._batch_done(job, live))
+
+    def _batch_done(self, job, live):
+        self._inflight.release()
+        if job.cancelled():
+            for item in live:
+                item[4].cancel()
+            return
+        if job.exception() is not None:
+            for item in live:
+                if not item[4].done():
+                    item[4].set_exception(job.exception())
+            return
+        for item, result in zip(live, job.result()):
+            future = item[4]
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+def _serve_decode(requests, fst=None):
+    """
+    Decode a batch of (input symbols, n, options) requests for
+    TransductionService, returning a PathList or an exception for
+    each.
+    """
+    if fst is None:
+        fst = _batch_fst
+    results = []
+    for symbols, n, options in requests:
+        try:
+            results.append(fst.decode(symbols, n, **options))
+        except Exception as e:
+            results.append(e)
+    return results
+
+_SERVE_OPTIONS = ('dups', 'astar', 'beam', 'max_active', 'max_expansions')
+
+async def _serve_connection(service, reader, writer):
+    """
+    Answer the requests of a client of serve(), one JSON object per
+    line, concurrently, writing each response as soon as it is ready.
+    """
+    tasks = set()
+    lock = asyncio.Lock()
+
+    async def answer(line):
+        rid = None
+        try:
+            request = json.loads(line)
+            rid = request.get('id')
+            options = dict((k, request[k]) for k in _SERVE_OPTIONS if k in request)
+            paths = await service.transduce(request['input'], request.get('n', 1),
+                                            request.get('sep', ' '), request.get('timeout'),
+                                            **options)
+            response = {'id': rid, 'pruned': paths.pruned,
+                        'paths': [{'weight': p.weight, 'input': p.input, 'output': p.output}
+                                  for p in paths]}
+        except asyncio.QueueFull:
+            response = {'id': rid, 'error': 'busy'}
+        except (TimeoutError, asyncio.TimeoutError):
+            response = {'id': rid, 'error': 'timeout'}
+        except Exception as e:
+            response = {'id': rid, 'error': '%s: %s' % (type(e).__name__, e)}
+        async with lock:
+            writer.write((json.dumps(response) + '\n').encode('utf-8'))
+            await writer.drain()
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                task = asyncio.ensure_future(answer(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve(fst, host='127.0.0.1', port=8765, **kwargs):
+    """
+    Serve transductions with fst over TCP until cancelled. Each
+    request is a line with a JSON object such as
+    {"id": 1, "input": "this is a test", "n": 3}, where input is a
+    string (split with "sep", by default " ") or a list of
+    symbols, and "timeout", "dups", "astar", "beam", "max_active"
+    and "max_expansions" are optional. Each response is a line with
+    {"id": 1, "pruned": false, "paths": [{"weight": ..., "input":
+    [...], "output": [...]}, ...]}, or {"id": 1, "error": ...},
+    where the error is "busy" if the queue is full and "timeout" if
+    the deadline was missed. Responses come as they are ready, not
+    necessarily in the order of the requests. The remaining
+    arguments are passed to TransductionService.
+    """
+    service = TransductionService(fst, **kwargs)
+    await service.start()
+    server = await asyncio.start_server(
+        lambda reader, writer: _serve_connection(service, reader, writer), host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+class TransductionClient(object):
+    """
+    A client for serve(), which sends requests over one connection
+    and matches responses to them, so that many requests can be in
+    flight at once:
+
+        client = TransductionClient()
+        await client.connect('127.0.0.1', 8765)
+        paths = await client.transduce('this is a test', n=3)
+        await client.close()
+
+    transduce() returns a list of Paths, and raises RuntimeError
+    with the error of the server if there is one.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._nextid = 0
+
+    async def connect(self, host='127.0.0.1', port=8765):
+        self._reader, self._writer = await asyncio.open_connection(host, port)
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._receiver.cancel()
+        try:
+            await self._receiver
+        except asyncio.CancelledError:
+            pass
+
+    async def transduce(self, input_symbols, n=1, **options):
+        rid = self._nextid
+        self._nextid += 1
+        request = dict(options)
+        request.update({'id': rid, 'input': input_symbols, 'n': n})
+        future = asyncio.get_running_loop().create_future()
+        self._pending[rid] = future
+        self._writer.write((json.dumps(request) + '\n').encode('utf-8'))
+        await self._writer.drain()
+        response = await future
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return [Path(p['weight'], p['input'], p['output']) for p in response['paths']]
+
+    async def _receive(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            future = self._pending.pop(response.get('id'), None)
+            if future is not None and not future.done():
+                future.set_result(response)
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('connection closed'))
+        self._pending.clear()
+
+def _command(argv):
+    """
+    Run the command line commands: serve an FST file, or send the
+    lines of stdin to a server as inputs and print the responses.
+    """
+    parser = argparse.ArgumentParser(prog='python -m fst')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('serve', help='serve transductions with an FST over TCP')
+    p.add_argument('fst_file')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--workers', type=int, default=None)
+    p.add_argument('--max-batch', type=int, default=32)
+    p.add_argument('--batch-wait', type=float, default=0.002,
+                   help='seconds to wait for more requests for a batch')
+    p.add_argument('--max-queue', type=int, default=1024)
+    p.add_argument('--timeout', type=float, default=None,
+                   help='default deadline of a request, in seconds')
+    p.add_argument('--max-expansions', type=int, default=None,
+                   help='default limit on the search of a request')
+    p = commands.add_parser('client', help='transduce the lines of stdin with a server')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('-n', type=int, default=1)
+    p.add_argument('--sep', default=' ')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        f = load(args.fst_file, mmap=True)
+        options = {}
+        if args.max_expansions is not None:
+            options['max_expansions'] = args.max_expansions
+        print('Serving', args.fst_file, 'on %s:%d' % (args.host, args.port), flush=True)
+        try:
+            asyncio.run(serve(f, args.host, args.port, workers=args.workers,
+                              max_batch=args.max_batch, batch_wait=args.batch_wait,
+                              max_queue=args.max_queue, timeout=args.timeout, **options))
+        except KeyboardInterrupt:
+            pass
+    else:
+        async def run():
+            client = TransductionClient()
+            await client.connect(args.host, args.port)
+            lines = [line.rstrip('\n') for line in sys.stdin]
+            results = await asyncio.gather(
+                *[client.transduce(line, args.n, sep=args.sep) for line in lines],
+                return_exceptions=True)
+            await client.close()
+            for line, paths in zip(lines, results):
+                print('Input:', line)
+                if isinstance(paths, Exception):
+                    print('Fail:', paths)
+                else:
+                    for p in paths:
+                        print(args.sep.join(p.output), p.weight)
+                print()
+        asyncio.run(run())
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) > 0:
+        _command(argv)
+        return
 
     # Encode a string as an FST, using white space as separator
     myfst1 = linear_chain_from_string("This is a test", ' ')
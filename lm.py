@@ -1,109 +1,328 @@
 #!/usr/bin/env python3
 
 import fst
+import argparse
+import contextlib
+import heapq
+import itertools
 import math
-import sys
-
-if len(sys.argv) == 4:
-    vocabsize = int(sys.argv[3])
-elif len(sys.argv) != 3:
-    print("Usage:", sys.argv[0], "input_file output_file [vocabsize]")
-    sys.exit(1)
-else:
-    vocabsize = 0
-
-w_bigram_cnt = {}
-w_unigram_cnt = {'<s>': 0}
-wb_lambda = {}
-wb_ctx = {'</s>': {}}
-w_cnt = 0
-
-print("Building LM...")
-line_cnt = 0
-with open(sys.argv[1], 'r', encoding='utf-8') as fp:
-    for line in fp:
-        line_cnt += 1
-        if line_cnt % 1000 == 0:
-            print(line_cnt, '...', end=' ', flush=True)
-        prev = '<s>'
-        w_unigram_cnt[prev] += 1
-        sent = line.split() + ['</s>']
-        while '.' in sent:
-            sent.remove('.')
-        for token in sent:
-            w_cnt += 1
-            if token in w_unigram_cnt:
-                w_unigram_cnt[token] += 1
-            else:
-                w_unigram_cnt[token] = 1
-            if (token, prev) in w_bigram_cnt:
-                w_bigram_cnt[(token, prev)] += 1
-            else:
-                w_bigram_cnt[(token, prev)] = 1
-            prev = token  
-
-print("\nFinished reading file.")      
-
-if vocabsize > 0:
-    unk_cnt = 0
-    types = sorted(w_unigram_cnt.items(), key=lambda a: a[1], reverse=True)
-    for word, cnt in types[vocabsize:]:
-        unk_cnt += cnt
-    w_unigram_cnt = dict(types[:vocabsize])
-    w_unigram_cnt['<unk>'] = unk_cnt
-
-print("Finished <unk> processing.")
-
-for (word, prev), cnt in list(w_bigram_cnt.items()):
-    rm = False
-    newword = word
-    newprev = prev
-    if word not in w_unigram_cnt:
-        newword = '<unk>'
-        rm = True
-    if prev not in w_unigram_cnt:
-        newprev = '<unk>'
-        rm = True
-    if (newword, newprev) not in w_bigram_cnt:
-        w_bigram_cnt[(newword, newprev)] = 0
-    if rm:
-        del w_bigram_cnt[(word, prev)]
-    w_bigram_cnt[(newword, newprev)] += cnt
-    if newprev not in wb_ctx:
-        wb_ctx[newprev] = set()
-    wb_ctx[newprev].add(newword)
-
-print("Finished estimating bigram parameters.")
-
-for word in w_unigram_cnt:
-    b = len(wb_ctx[word])
-    wb_lambda[word] = b/(b+w_unigram_cnt[word])
-
-print("Finished estimating unigram parameters.")
-
-wlm = fst.FST()
-wlm.set_initial('<s>')
-wlm.set_final('</s>')
-
-for w, pw in w_bigram_cnt:
-    bigram_p = wb_lambda[w] * w_bigram_cnt[(w, pw)]/w_unigram_cnt[pw]
-    unigram_p = (1 - wb_lambda[w]) * w_unigram_cnt[w]/w_cnt
-    logp = -1 * math.log(bigram_p + unigram_p)
-
-    if not w == '</s>':
-        wlm.add_transition(pw, w, w, w, logp)
-    else:
-        wlm.add_transition(pw, w, fst.EPS, fst.EPS, logp)
-    
-for w in w_unigram_cnt:
-    unigram_p = w_unigram_cnt[w]/w_cnt
-    logp = -1 * math.log(unigram_p)
-    wlm.add_transition(w, '<unigram_state>', fst.EPS, fst.EPS, 0)
-    if not w == '</s>':
-        wlm.add_transition('<unigram_state>', w, w, w, logp)
-    else:
-        wlm.add_transition('<unigram_state>', w, fst.EPS, fst.EPS, logp)
-    
-print("Done")
-
-wlm.save(sys.argv[2])
+import multiprocessing
+import os
+import shutil
+import tempfile
+from array import array
+from collections import Counter, deque
+
+# Counting is done by a pool of worker processes, each counting the
+# ngrams of a chunk of lines and writing them to a shard file, sorted,
+# as lines of "w1 w2 ... wn<TAB>count". The shards are then merged
+# with a constant amount of memory per shard, adding up the counts
+# of the same ngram.
+
+_order = None
+_vocab = None
+_shard_dir = None
+
+def count_init(order, vocab, shard_dir):
+    """
+    Set up a counting worker.
+    """
+    global _order, _vocab, _shard_dir
+    _order = order
+    _vocab = vocab
+    _shard_dir = shard_dir
+
+def sentence(line, vocab=None):
+    """
+    Return the list of tokens of a line, with <s> and </s> added,
+    periods removed, and words out of vocab (if given) replaced by
+    <unk>.
+    """
+    tokens = [tok for tok in line.split() if tok != '.']
+    if vocab is not None:
+        tokens = [tok if tok in vocab else '<unk>' for tok in tokens]
+    return ['<s>'] + tokens + ['</s>']
+
+def count_chunk(lines):
+    """
+    Count the ngrams of orders 1 to _order in a chunk of lines,
+    write them to a new shard file, and return its name. Only
+    ngrams that predict a word after <s> are counted, and ngrams
+    don't go across sentences.
+    """
+    counts = Counter()
+    for line in lines:
+        sent = sentence(line, _vocab)
+        for i in range(1, len(sent)):
+            for n in range(1, min(_order, i + 1) + 1):
+                counts[' '.join(sent[i - n + 1:i + 1])] += 1
+
+    # The lines are sorted as a whole, so that the lines of the same
+    # ngram are next to each other when shards are merged.
+    lines = sorted('%s\t%d\n' % (ngram, cnt) for ngram, cnt in counts.items())
+    fd, fname = tempfile.mkstemp(suffix='.counts', dir=_shard_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+        fp.writelines(lines)
+    return fname
+
+def read_chunks(fname, chunk_lines):
+    """
+    Read a file in chunks of chunk_lines lines.
+    """
+    with open(fname, 'r', encoding='utf-8') as fp:
+        chunk = []
+        for line in fp:
+            chunk.append(line)
+            if len(chunk) == chunk_lines:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+def write_shards(fname, order, vocab, workers, chunk_lines, shard_dir):
+    """
+    Count the ngrams in fname into shard files in shard_dir, and
+    return their names.
+    """
+    shards = []
+    nlines = 0
+    chunks = read_chunks(fname, chunk_lines)
+    if workers == 1:
+        count_init(order, vocab, shard_dir)
+        for chunk in chunks:
+            shards.append(count_chunk(chunk))
+            nlines += len(chunk)
+            print(nlines, '...', end=' ', flush=True)
+        return shards
+
+    # Only a few chunks per worker are read ahead, so the corpus is
+    # never all in memory.
+    with multiprocessing.Pool(workers, count_init, (order, vocab, shard_dir)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((len(chunk), pool.apply_async(count_chunk, (chunk,))))
+            if len(pending) >= 2 * workers:
+                n, result = pending.popleft()
+                shards.append(result.get())
+                nlines += n
+                print(nlines, '...', end=' ', flush=True)
+        while len(pending) > 0:
+            n, result = pending.popleft()
+            shards.append(result.get())
+            nlines += n
+            print(nlines, '...', end=' ', flush=True)
+    return shards
+
+def merge_shards(shards):
+    """
+    Merge sorted shard files into a sorted stream of
+    (ngram, count) pairs, where ngram is a tuple of words.
+    """
+    files = [open(shard, 'r', encoding='utf-8') for shard in shards]
+    try:
+        entries = (line.rstrip('\n').split('\t') for line in heapq.merge(*files))
+        prev = None
+        total = 0
+        for ngram, cnt in entries:
+            if ngram != prev:
+                if prev is not None:
+                    yield tuple(prev.split(' ')), total
+                prev = ngram
+                total = 0
+            total += int(cnt)
+        if prev is not None:
+            yield tuple(prev.split(' ')), total
+    finally:
+        for fp in files:
+            fp.close()
+
+@contextlib.contextmanager
+def count_ngrams(fname, order, vocab=None, workers=None, chunk_lines=100000, tmpdir=None):
+    """
+    Count the ngrams of orders 1 to order in the corpus fname,
+    one sentence per line, into sorted shard files, and return a
+    context manager that gives the list of their names, and removes
+    them at the end of the with block. merge_shards() reads the
+    counts from them, as many times as needed.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    shard_dir = tempfile.mkdtemp(prefix='lm-counts-', dir=tmpdir)
+    try:
+        shards = write_shards(fname, order, vocab, workers, chunk_lines, shard_dir)
+        print()
+        yield shards
+    finally:
+        shutil.rmtree(shard_dir)
+
+def select_vocab(unigrams, vocabsize):
+    """
+    Return the set of the vocabsize most frequent words, from a
+    dict of unigram counts, plus <s>, </s> and <unk>.
+    """
+    words = [(cnt, w) for (w,), cnt in unigrams.items() if w not in ('<s>', '</s>')]
+    words.sort(key=lambda a: a[0], reverse=True)
+    return set(w for cnt, w in words[:vocabsize]) | set(['<s>', '</s>', '<unk>'])
+
+def state_name(hist):
+    """
+    Return the name of the LM state for a history (a tuple).
+    """
+    if len(hist) == 0:
+        return '<unigram_state>'
+    return ' '.join(hist)
+
+def build_lm(lower, top, order):
+    """
+    Estimate a Witten-Bell interpolated ngram LM from ngram counts,
+    and encode it as an FST. Each history seen in training is a
+    state, with a transition for each word seen after it, weighted
+    with the interpolated -log P(word | history), and a failure
+    (PHI) transition to the state of its shortened history, weighted
+    with -log of the backoff weight T(h) / (c(h) + T(h)), where c(h)
+    is the count of the history and T(h) the number of word types
+    seen after it. The end of sentence is an EPS transition to the
+    final state </s>. The LM is returned as a ConstFST, with the
+    history of each state in its state_names.
+
+    lower is a dict of the counts of the ngrams of orders 1 to
+    order - 1, and top is a stream of (ngram, count) pairs of the
+    ngrams of the highest order, in the sorted order of
+    merge_shards(), where the ngrams of a history are next to each
+    other. Only the lower orders are kept in memory: the highest
+    order is read a history at a time.
+    """
+    # The count and the number of followers of each history of the
+    # lower orders.
+    histcnt = Counter()
+    histtypes = Counter()
+    for ngram, cnt in lower.items():
+        histcnt[ngram[:-1]] += cnt
+        histtypes[ngram[:-1]] += 1
+
+    # Probabilities of the lower orders, from lower to higher.
+    prob = {}
+
+    def interpolate(ngram, cnt, c, t):
+        if len(ngram) == 1:
+            return cnt / c
+        return (cnt + t * prob[ngram[1:]]) / (c + t)
+
+    for ngram in sorted(lower, key=len):
+        h = ngram[:-1]
+        prob[ngram] = interpolate(ngram, lower[ngram], histcnt[h], histtypes[h])
+
+    # The transitions are collected in arrays and the FST is built
+    # with fst.from_arrays(), much faster than adding them one at a
+    # time. State and symbol names are interned as integer ids.
+    state_names = []
+    state_ids = {}
+    symbols = [fst.EPS]
+    symbol_ids = {fst.EPS: 0}
+    src = array('i')
+    dst = array('i')
+    labels = array('i')
+    weights = array('d')
+
+    def intern(name, ids, names):
+        i = ids.get(name)
+        if i is None:
+            i = ids[name] = len(names)
+            names.append(name)
+        return i
+
+    def add(state1, state2, sym, weight):
+        src.append(intern(state1, state_ids, state_names))
+        dst.append(intern(state2, state_ids, state_names))
+        labels.append(intern(sym, symbol_ids, symbols))
+        weights.append(weight)
+
+    initial = intern('<s>' if order > 1 else '<unigram_state>', state_ids, state_names)
+    final = intern('</s>', state_ids, state_names)
+
+    # A history of order - 1 words that does not end with </s> is
+    # always followed by some word in the corpus, so it is the
+    # history of ngrams of the highest order. Shorter histories are
+    # those of the lower orders.
+    def is_history(hist):
+        return len(hist) == order - 1 or hist in histcnt
+
+    def add_ngram(ngram, p):
+        h = ngram[:-1]
+        w = ngram[-1]
+        if w == '</s>':
+            add(state_name(h), '</s>', fst.EPS, -math.log(p))
+            return
+        # The next state is the longest history we have for the
+        # words seen so far.
+        nexthist = (h + (w,))[-(order - 1):] if order > 1 else ()
+        while not is_history(nexthist):
+            nexthist = nexthist[1:]
+        add(state_name(h), state_name(nexthist), w, -math.log(p))
+
+    def add_backoff(h, c, t):
+        if len(h) > 0:
+            add(state_name(h), state_name(h[1:]), fst.PHI, -math.log(t / (c + t)))
+
+    for ngram, p in prob.items():
+        add_ngram(ngram, p)
+    for h in histcnt:
+        add_backoff(h, histcnt[h], histtypes[h])
+
+    # The highest order, a history at a time.
+    group = []
+    for ngram, cnt in itertools.chain(top, [(None, 0)]):
+        if len(group) > 0 and (ngram is None or ngram[:-1] != group[0][0][:-1]):
+            h = group[0][0][:-1]
+            c = sum(n for g, n in group)
+            for g, n in group:
+                add_ngram(g, interpolate(g, n, c, len(group)))
+            add_backoff(h, c, len(group))
+            group = []
+        if ngram is not None:
+            group.append((ngram, cnt))
+
+    lm = fst.from_arrays(src, dst, labels, labels, weights, symbols, initial, [final],
+                         len(state_names), state_names)
+    return lm
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a word ngram LM as an FST.')
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('vocabsize', type=int, nargs='?', default=0,
+                        help='keep only the most frequent words, and map the others to <unk>')
+    parser.add_argument('--order', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of counting processes (default: one per CPU)')
+    parser.add_argument('--chunk-lines', type=int, default=100000,
+                        help='number of lines counted by a worker at a time')
+    parser.add_argument('--tmpdir', default=None,
+                        help='directory for the temporary count files')
+    args = parser.parse_args()
+    if args.order < 1:
+        parser.error('the order must be at least 1')
+
+    vocab = None
+    if args.vocabsize > 0:
+        print("Counting words...")
+        with count_ngrams(args.input_file, 1, None, args.workers,
+                          args.chunk_lines, args.tmpdir) as shards:
+            vocab = select_vocab(dict(merge_shards(shards)), args.vocabsize)
+        print("Finished <unk> processing.")
+
+    print("Building LM...")
+    with count_ngrams(args.input_file, args.order, vocab, args.workers,
+                      args.chunk_lines, args.tmpdir) as shards:
+        print("Finished reading file.")
+        lower = dict((ngram, cnt) for ngram, cnt in merge_shards(shards)
+                     if len(ngram) < args.order)
+        top = ((ngram, cnt) for ngram, cnt in merge_shards(shards)
+               if len(ngram) == args.order)
+        lm = build_lm(lower, top, args.order)
+    print("Done")
+
+    lm.save(args.output_file)
+
+if __name__ == '__main__':
+    main()
@@ -8,4 +8,8 @@ setup(
     author='Kenji Sagae',
 
     py_modules=['fst'],
+
+    extras_require={
+        'numpy': ['numpy'],
+    },
 )
\ No newline at end of file
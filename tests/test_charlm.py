@@ -0,0 +1,18 @@
+import os
+import subprocess
+import sys
+
+import fst
+
+CHARLM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'charlm.py')
+
+
+def test_charlm_replaces_bar(tmp_path):
+    (tmp_path / 'train.txt').write_text('a|b\nab/\n', encoding='utf-8')
+    subprocess.run([sys.executable, CHARLM, '2', str(tmp_path / 'train.txt'),
+                    str(tmp_path / 'lm.fst')], check=True, stdout=subprocess.DEVNULL)
+    lm = fst.load(str(tmp_path / 'lm.fst'))
+    assert '|' not in lm.symbols
+    assert '/' in lm.symbols
+    assert len(lm.decode(list('a/b') + ['</s>'])) == 1
+    assert len(lm.decode(list('a|b') + ['</s>'])) == 0
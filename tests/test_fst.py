@@ -0,0 +1,80 @@
+import pytest
+
+import fst
+from fst import EPS
+
+
+def test_decode_beam_through_eps_final_arc():
+    # Like the end of sentence arcs of lm.py: the final state is only
+    # reached through an epsilon move that costs more than the beam.
+    f = fst.FST()
+    f.set_initial(0)
+    f.add_transition(0, 1, 'a', 'a', 0.5)
+    f.add_transition(1, 2, EPS, EPS, 2.0)
+    f.set_final(2)
+    for g in (f, f.freeze()):
+        for beam in (0.5, 1, 2):
+            paths = g.decode(['a'], beam=beam)
+            assert [(p.weight, p.input) for p in paths] == [(2.5, ['a'])]
+            paths = fst.compose(fst.linear_chain(['a']), g).short_paths(beam=beam)
+            assert [(p.weight, p.input) for p in paths] == [(2.5, ['a'])]
+
+
+def test_read_att_epsilon_symbol_table(tmp_path):
+    # OpenFst calls id 0 <epsilon>.
+    (tmp_path / 'f.txt').write_text('0\t1\t<epsilon>\tx\t1.5\n1\t2\ta\t<epsilon>\n2\n')
+    (tmp_path / 'i.syms').write_text('<epsilon>\t0\na\t1\n')
+    (tmp_path / 'o.syms').write_text('<epsilon>\t0\nx\t1\n')
+    f = fst.read_att(str(tmp_path / 'f.txt'), str(tmp_path / 'i.syms'), str(tmp_path / 'o.syms'))
+    paths = f.decode(['a'])
+    assert [(p.weight, p.input, p.output) for p in paths] == [(1.5, ['a'], ['x'])]
+
+
+def test_read_att_numeric_labels(tmp_path):
+    # fstprint without symbol tables: label 0 is EPS.
+    (tmp_path / 'f.txt').write_text('0\t1\t0\t3\t1.5\n1\t2\t5\t0\n2\n')
+    f = fst.read_att(str(tmp_path / 'f.txt'))
+    paths = f.decode(['5'])
+    assert [(p.weight, p.input, p.output) for p in paths] == [(1.5, ['5'], ['3'])]
+
+
+def test_write_att_needs_string_symbols(tmp_path):
+    f = fst.FST()
+    f.set_initial(0)
+    f.add_transition(0, 1, 7, 7, 1.0)
+    f.set_final(1)
+    with pytest.raises(ValueError):
+        fst.write_att(f, str(tmp_path / 'f.txt'))
+
+
+def test_from_arrays_numpy_states():
+    np = pytest.importorskip('numpy')
+    f = fst.from_arrays(np.array([0, 1]), np.array([1, 2]), np.array([1, 2]), np.array([1, 2]),
+                        np.array([0.5, 1.0]), [EPS, 'a', 'b'],
+                        initial=np.int64(0), final=np.array([2]))
+    assert [p.weight for p in f.decode(['a', 'b'])] == [1.5]
+
+
+def test_inverted_lazy_compose():
+    f = fst.FST()
+    f.set_initial(0)
+    f.add_transition(0, 1, 'a', 'b', 1.0)
+    f.set_final(1)
+    g = fst.FST()
+    g.set_initial(0)
+    g.add_transition(0, 1, 'b', 'c', 0.5)
+    g.set_final(1)
+    inv = fst.inverted(fst.compose(f, g, lazy=True))
+    assert [(p.weight, p.input, p.output) for p in inv.short_paths()] == [(1.5, ['c'], ['a'])]
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_binary_state_names(tmp_path, mmap):
+    names = ['<s>', 'the', 'the cat', 'café']
+    f = fst.from_arrays([0, 1, 2], [1, 2, 3], [1, 2, 1], [1, 2, 1], [0.5, 1.0, 2.0],
+                        [EPS, 'a', 'b'], initial=0, final=[3], state_names=names)
+    f.save(str(tmp_path / 'f.fstb'))
+    g = fst.load(str(tmp_path / 'f.fstb'), mmap=mmap)
+    assert g.state_names == names
+    assert [g.state_names[i] for i in (3, -1, 0)] == ['café', 'café', '<s>']
+    assert g.thaw().short_paths()[0].weight == 3.5